@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from erddap import erddap, filtered
+from erddap import erddap, format_epoch, PERIODS, TRANSPORTS, netCDF4
 from datetime import datetime, date, timedelta
 import sqlite3
+import numpy as np
 import pandas as pd
 import argparse
 import sys
@@ -10,8 +11,16 @@ import os
 import xarray as xr
 import inflection
 import math
+import errno
+import hashlib
+import json
 from xml.sax.saxutils import escape
 import shutil
+from functools import partial
+from contextlib import contextmanager
+import cProfile
+import metrics
+import time
  
 class StdevFunc:
     def __init__(self):
@@ -32,8 +41,13 @@ class StdevFunc:
             return None
         return math.sqrt(self.S / (self.k-2))
   
-def new_erddap():
-   return erddap("http://erddap.marine.ie/erddap")
+def new_erddap(workers=1,cache_dir=None,cache_size=1024,target_rows=None,target_window_size=None,timeout=300,
+               transport="csv",http_retries=3):
+   target_bytes = None if target_window_size is None else int(target_window_size*1024*1024)
+   return erddap("http://erddap.marine.ie/erddap",workers=workers,
+                 cache_dir=cache_dir,cache_bytes=cache_size*1024*1024,
+                 target_rows=target_rows,target_bytes=target_bytes,timeout=timeout,transport=transport,
+                 retries=http_retries)
 
 def translate_type(s):
    if s.name in ["float16", "float32"]:
@@ -65,86 +79,387 @@ def mdvars(seq,match):
           wanted = False
     if wanted: yield o
 
-def aggregate(ts,min_date,period,data_dir,dataset_dir,constraints):
-    max_date = nextmonth(min_date)
-    sqlite = ts.sqlite()
-    # or should everything be put in one database...
-    dbfile = '/var/tmp/{0}_{1}.db'.format(sqlite.table_name,period)
-    try:
-      os.remove(dbfile)
-    except OSError:
-      pass
+def sqlite_connect(dbfile):
     conn = sqlite3.connect(dbfile)
+    # the database is thrown away after the aggregation, so skip durability
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")
     conn.create_aggregate("stdev",1,StdevFunc)
+    return conn
+
+def stream_results(streams,chunk_rows=None):
+    if chunk_rows:
+       return {stream.period: partial(stream.chunks,chunk_rows) for stream in streams if stream.count}
+    with metrics.stage("to_dataframe"):
+       return {stream.period: stream.frame() for stream in streams if stream.count}
+
+def sqlite_dataframes(ts,periods,min_date,max_date,constraints,in_memory=False,chunk_rows=None,read_rows=100000):
+    sqlite = ts.sqlite()
+    if in_memory:
+      dbfile = ":memory:"
+    else:
+      # one database holds the rows for every period, one per month so months can run in parallel
+      dbfile = '/var/tmp/{0}_{1}_{2:%Y_%m}.db'.format(sqlite.table_name,"_".join(periods),min_date)
+      try:
+        os.remove(dbfile)
+      except OSError:
+        pass
+    conn = sqlite_connect(dbfile)
 
     c = conn.cursor()
     #print(sqlite.sql_create_table())
     c.execute(sqlite.sql_create_table())
     query = sqlite.sql_insert()
     #print(query)
-    batch = []
-    i = 0
-    for o in ts.data(min_date,max_date,constraints):
-       i = i + 1
-       t = sqlite.tuplify(o)
-       batch.append(t)
-       if i % 1000 == 0:
-         #print('{:%Y-%m-%d %H:%M:%S} {}'.format(datetime.now(),i), end="\r")
-         c.executemany(query,batch)
-         batch = []
-         if i % 500000 == 0:
-             conn.commit()
-    if len(batch):
-       c.executemany(query,batch)
-    if i == 0:
-       return;
-    primary_keys = ','.join([o["name"] for o in filtered(sqlite.columns,{"key": True})])
-    sqlidx = "create index idx_{0}_{1} on {0}({2},{1})".format(sqlite.table_name,period,primary_keys);
-    c.execute(sqlidx);
+    # the rows are streamed in, so this stage includes the download windows
+    with metrics.stage("sqlite_ingest"):
+      names = [v["lcname"] for v in ts.variables()]
+      c.executemany(query,sqlite.row_tuples(ts.rows(min_date,max_date,constraints),names))
+    if c.rowcount <= 0:
+       conn.close()
+       return {}
     conn.commit()
-    df = pd.read_sql(sqlite.sql_aggregate(period),conn);
+    streams = [ts.stream(period) for period in periods]
+    with metrics.stage("sqlite_aggregate"):
+      if chunk_rows:
+         # a scan per period in the order of its buckets, only the bucket being
+         # read is held, the finished ones go to disk until they are written
+         keys = ",".join(streams[0].keys)
+         for stream in streams:
+            c.execute("create index idx_{0}_{1} on {0}({1}{2})".format(sqlite.table_name,stream.period,","+keys if keys else ""))
+            for df in pd.read_sql(sqlite.sql_rows(stream.period),conn,chunksize=read_rows):
+               stream.add_batch(df)
+               stream.spill_finished(chunk_rows)
+      else:
+         # one scan of the staged rows for every period, reduced with numpy read_rows rows at a time
+         for df in pd.read_sql(sqlite.sql_rows(),conn,chunksize=read_rows):
+            for stream in streams:
+               stream.add_batch(df)
     conn.close()
-    # create xarray Dataset from Pandas DataFrame
+    return stream_results(streams,chunk_rows)
+
+def stream_dataframes(ts,periods,min_date,max_date,constraints,streams=None,chunk_rows=None):
+    """
+    Reduces the batches of the month as they are downloaded. With
+    chunk_rows the buckets finished by each window go to disk until they
+    are written, as the windows come in time order, so only the buckets of
+    the current period and a window of rows are held. The streams of an
+    incremental run keep every bucket, their states are saved.
+    """
+    spill = chunk_rows and streams is None
+    if streams is None:
+       streams = [ts.stream(period) for period in periods]
+    # the bucket keys for every period are worked out once per batch
+    prepare = streams[0].prepare_batch
+    for df in ts.batches(min_date,max_date,constraints):
+       with metrics.stage("prepare"):
+          df = prepare(df)
+       with metrics.stage("reduce"):
+          for stream in streams:
+             stream.add_batch(df)
+             if spill:
+                stream.spill_finished(chunk_rows)
+    return stream_results(streams,chunk_rows)
+
+engines = {
+    "stream": stream_dataframes,
+    "sqlite": sqlite_dataframes,
+    "sqlite_memory": partial(sqlite_dataframes,in_memory=True),
+}
+
+def output_paths(ts,min_date,period,data_dir,dataset_dir):
+    dataset_id = "{0}_{1}".format(ts.base_table_name(),period)
+    filedir = "{0}/{1}/".format(data_dir,dataset_id)
+    filepath = "{0}{1}.nc".format(filedir,min_date.strftime("%Y/{0}_%Y_%m_%d".format(dataset_id)))
+    configpath = "{0}/{1}.part".format(dataset_dir,dataset_id)
+    return dataset_id, filedir, filepath, configpath
+
+def state_path(filepath):
+    return "{0}.state.json".format(filepath[:-len(".nc")])
+
+PARTITIONS = ["day","week","month"]
+
+def manifest_path(ts,min_date,period,data_dir,dataset_dir):
+    dataset_id, filedir = output_paths(ts,min_date,period,data_dir,dataset_dir)[:2]
+    return "{0}{1}.manifest.json".format(filedir,min_date.strftime("%Y/{0}_%Y_%m".format(dataset_id)))
+
+def load_manifest(path):
+    """
+    The files written for a month, by path relative to the dataset folder,
+    with the start and end of their partition, the number of rows, the
+    first and last time and the hash of the rows.
+    """
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      return json.load(f)
+
+def save_manifest(path,manifest):
+    tmp = "{0}.{1}.tmp".format(path,os.getpid())
+    with open(tmp,"w") as out:
+      json.dump(manifest,out,indent=1,sort_keys=True)
+    shutil.move(tmp,path)
+
+def output_exists(ts,min_date,period,data_dir,dataset_dir):
+    return (os.path.exists(manifest_path(ts,min_date,period,data_dir,dataset_dir)) or
+            os.path.exists(output_paths(ts,min_date,period,data_dir,dataset_dir)[2]))
+
+def source_path(filepath):
+    return "{0}.source.json".format(filepath[:-len(".nc")])
+
+def source_record(fingerprint,constraints,partition,compression,float32):
+    # the same rows filtered or written another way give other files
+    return {"fingerprint": fingerprint, "constraints": constraints, "partition": partition,
+            "compression": compression, "float32": float32}
+
+def source_records(ts,min_date,periods,data_dir,dataset_dir):
+    """
+    The source record each period of the month was last written with, None
+    for the periods without files or without a record.
+    """
+    answer = []
+    for period in periods:
+       path = source_path(output_paths(ts,min_date,period,data_dir,dataset_dir)[2])
+       answer.append(load_manifest(path) if output_exists(ts,min_date,period,data_dir,dataset_dir) else None)
+    return answer
+
+def partition_frames(frames,min_date,partition,period):
+    """
+    Splits the DataFrames of an aggregation, in period order, by day or by
+    week (monday to sunday, cut at the ends of the month) and yields the
+    (start, end, DataFrame) of each partition. A row goes in the partition
+    of the start of its bucket, as weekly and monthly buckets of different
+    stations have different mean times. Only the rows of one partition are
+    held at a time.
+    """
+    epoch = date(1970,1,1)
+    first = (min_date - epoch).days
+    last = (nextmonth(min_date) - epoch).days
+    current = None
+    pending = []
+    for df in frames:
+       # the mean time of a bucket is within it, its day gives the start of the bucket
+       days = df["time"].values.astype(np.int64) // 86400
+       if period == "weekly":
+          days = np.maximum(days - (days + 3) % 7,first)
+       elif period == "monthly":
+          days = np.full(len(days),first,dtype=np.int64)
+       if partition == "week":
+          days = np.maximum(days - (days + 3) % 7,first)
+       for start in np.unique(days).tolist():
+          if current is not None and start < current:
+             raise ValueError("the rows of the partition of {0} came after those of a later one".format(epoch + timedelta(days=start)))
+          if start != current and pending:
+             yield partition_range(current,partition,last) + (pd.concat(pending,ignore_index=True),)
+             pending = []
+          current = start
+          pending.append(df[days == start])
+    if pending:
+       yield partition_range(current,partition,last) + (pd.concat(pending,ignore_index=True),)
+
+def partition_range(start,partition,last):
+    epoch = date(1970,1,1)
+    end = start + 1 if partition == "day" else min(start - (start + 3) % 7 + 7,last)
+    return epoch + timedelta(days=start), epoch + timedelta(days=end)
+
+def partition_entry(frames,start,end):
+    """
+    The manifest entry of a partition from its DataFrames: the hash covers
+    the columns and every value, so unchanged rows give the same hash.
+    """
+    digest = hashlib.sha1()
+    rows = 0
+    times = []
+    for df in frames:
+       if not len(df):
+          continue
+       if not rows:
+          digest.update(json.dumps(list(df.columns)))
+       digest.update(pd.util.hash_pandas_object(df,index=False).values.tobytes())
+       rows += len(df)
+       times.extend([df["time"].min(),df["time"].max()])
+    return {"start": start.isoformat(), "end": end.isoformat(), "rows": rows,
+            "min_time": format_epoch(min(times)) if times else None,
+            "max_time": format_epoch(max(times)) if times else None,
+            "sha1": digest.hexdigest()}
+
+def write_partitions(ts,result,min_date,period,data_dir,dataset_dir,partition="month",chunk_rows=None,
+                     compression=None,float32=False):
+    """
+    Writes an aggregation, a DataFrame or with chunk_rows a function of
+    its chunks, as one netcdf file per partition of the month and records
+    them in the month's manifest. A partition whose rows hash the same as
+    in the manifest isn't written again, and the files of the month that
+    are no longer in it are removed.
+    """
+    dataset_id, filedir = output_paths(ts,min_date,period,data_dir,dataset_dir)[:2]
+    path = manifest_path(ts,min_date,period,data_dir,dataset_dir)
+    old = load_manifest(path)
+    if old is None:
+       # written before there were manifests, one file for the month
+       old = {os.path.relpath(output_paths(ts,min_date,period,data_dir,dataset_dir)[2],filedir): {}}
+    if partition == "month":
+       parts = [(min_date,nextmonth(min_date),result)]
+    elif chunk_rows:
+       parts = partition_frames(result(),min_date,partition,period)
+    else:
+       parts = partition_frames([result.sort_values("time",kind="mergesort")],min_date,partition,period)
+    manifest = {}
+    for start, end, data in parts:
+       filepath = output_paths(ts,start,period,data_dir,dataset_dir)[2]
+       name = os.path.relpath(filepath,filedir)
+       with metrics.stage("hash"):
+         entry = partition_entry(data() if callable(data) else [data],start,end)
+       if compression or float32:
+          # the same rows written another way are a change too
+          entry["encoding"] = {"compression": compression, "float32": float32}
+       manifest[name] = entry
+       if old.get(name) == entry and os.path.exists(filepath):
+          metrics.count("partitions_unchanged")
+          continue
+       metrics.count("partitions_written")
+       if callable(data):
+          write_chunks(ts,data,start,period,data_dir,dataset_dir,chunk_rows,compression,float32)
+       else:
+          write_aggregation(ts,data,start,period,data_dir,dataset_dir,compression,float32)
+    for name in old:
+       if name not in manifest and os.path.exists(os.path.join(filedir,name)):
+          os.remove(os.path.join(filedir,name))
+    make_dirs(path,path)
+    save_manifest(path,manifest)
+
+def incremental_dataframes(ts,periods,min_date,max_date,constraints,data_dir,dataset_dir,chunk_rows=None):
+    """
+    Restores each period's bucket states saved by the previous run and
+    fetches only the rows after the oldest of their last processed times.
+    """
+    streams = []
+    for period in periods:
+       stream = ts.stream(period)
+       filepath = output_paths(ts,min_date,period,data_dir,dataset_dir)[2]
+       if output_exists(ts,min_date,period,data_dir,dataset_dir) and os.path.exists(state_path(filepath)):
+          stream.load_state(state_path(filepath))
+       streams.append(stream)
+    last_times = [stream.last_time for stream in streams]
+    if None not in last_times:
+       since = min(last_times)
+       constraints = constraints + ["{0}>{1}".format(ts.time_column(),format_epoch(since))]
+       mt = datetime.utcfromtimestamp(since)
+       min_date = date(mt.year,mt.month,mt.day)
+    dfs = stream_dataframes(ts,periods,min_date,max_date,constraints,streams=streams,chunk_rows=chunk_rows)
+    return dfs, {stream.period: stream for stream in streams}
+
+def aggregate(ts,min_date,periods,data_dir,dataset_dir,constraints,engine="stream",incremental=False,chunk_rows=None,
+              partition="month",compression=None,float32=False,skip_unchanged_source=False):
+    """
+    Aggregates a month of ts for each period and writes the netcdf files.
+    With skip_unchanged_source the server is first asked for the fingerprint of
+    the month, and nothing is downloaded when the files were written from
+    a source with the same fingerprint.
+    """
+    if isinstance(periods,basestring):
+       periods = [periods]
+    max_date = nextmonth(min_date)
+    metrics.reset()
+    start = time.time()
+    record = None
+    if skip_unchanged_source:
+       fingerprint = ts.fingerprint(min_date,max_date,constraints)
+       if fingerprint is not None:
+          record = source_record(fingerprint,constraints,partition,compression,float32)
+          records = source_records(ts,min_date,periods,data_dir,dataset_dir)
+          if all([r == record for r in records]):
+             print("unchanged source {0} {1:%Y-%m}".format(ts.id,min_date))
+             metrics.record("aggregate",dataset=ts.id,month=min_date.strftime("%Y-%m"),periods=periods,
+                            skipped=True,seconds=time.time()-start,**metrics.summary())
+             return
+          # the month is downloaded, its cached windows may be older than the
+          # fingerprint saved with the new files, also when a period had no record
+          ts.expire_cached(min_date,max_date)
+    if incremental:
+       dfs, streams = incremental_dataframes(ts,periods,min_date,max_date,constraints,data_dir,dataset_dir,chunk_rows)
+    else:
+       dfs = engines[engine](ts,periods,min_date,max_date,constraints,chunk_rows=chunk_rows)
+    for period in periods:
+       if period in dfs:
+          write_partitions(ts,dfs[period],min_date,period,data_dir,dataset_dir,partition,chunk_rows,
+                           compression,float32)
+       if period in dfs and incremental:
+          filepath = output_paths(ts,min_date,period,data_dir,dataset_dir)[2]
+          streams[period].save_state(state_path(filepath))
+       if period in dfs:
+          # written from the source as it was fingerprinted before the download,
+          # a change made during it is seen by the next run
+          path = source_path(output_paths(ts,min_date,period,data_dir,dataset_dir)[2])
+          if record is not None:
+             save_manifest(path,record)
+          elif os.path.exists(path):
+             os.remove(path)
+    seconds = time.time() - start
+    summary = metrics.summary()
+    rows = summary["counters"].get("rows",0)
+    metrics.record("aggregate",dataset=ts.id,month=min_date.strftime("%Y-%m"),periods=periods,
+                   engine=engine,incremental=incremental,partition=partition,compression=compression,float32=float32,seconds=seconds,rows=rows,
+                   rows_per_second=rows/seconds if seconds > 0 else None,**summary)
+
+def parse_times(df):
     encoding = {}
-    for column in df:
-      if column.endswith("time"):
-        df[column] = pd.to_datetime(df[column],infer_datetime_format=True)
-        encoding[column] = {
-              "units": "seconds since 1970-01-01T00:00:00Z" }
-    xds = xr.Dataset.from_dataframe(df)
+    with metrics.stage("parse_times"):
+      for column in df:
+        if column.endswith("time"):
+          # the engines keep times as epoch seconds until here
+          df[column] = pd.to_datetime(df[column],unit="s")
+          encoding[column] = {
+                "units": "seconds since 1970-01-01T00:00:00Z" }
+    return encoding
+
+def describe(ts,df,period):
+    """
+    The xarray Dataset of an aggregation with the attributes of the source
+    dataset and its variables.
+    """
+    with metrics.stage("to_xarray"):
+      xds = xr.Dataset.from_dataframe(df)
     summary = ts.summary()
     xds.attrs.update(summary)
     if "title" in summary:
       xds.attrs.update({"title": "{0}{1} aggregations of {2}".format(period[0].upper(),period[1:],summary["title"])})
 
-    metadata = [x for x in ts.metadata()]
-    for v in metadata:
-       if v["Row Type"] == "attribute":
-         value = v["Value"]
-         lcv = inflection.underscore(v["Variable Name"])
-         if v["Attribute Name"] == "units" and lcv.endswith("time"):
+    for name, attributes in ts.attributes().items():
+       lcv = inflection.underscore(name)
+       for attribute, value in attributes.items():
+         if attribute == "units" and lcv.endswith("time"):
             continue
          if lcv in xds:
-           xds[lcv].attrs.update({v["Attribute Name"]: v["Value"]})
+           xds[lcv].attrs.update({attribute: value})
          for agg in ["mean","stdev","maximum","minimum"]:
            k = "{0}_{1}".format(agg,lcv)
-           v2 = v["Value"]
-           if v["Attribute Name"] in ["long_name","standard_name"]:
+           v2 = value
+           if attribute in ["long_name","standard_name"]:
               v2 = "{0} {1}".format(agg,v2)
            if k in xds:
-              xds[k].attrs.update({v["Attribute Name"]: v2})
+              xds[k].attrs.update({attribute: v2})
+    return xds
 
-    dataset_id = "{0}_{1}".format(sqlite.table_name,period)
-    filedir = "{0}/{1}/".format(data_dir,dataset_id)
-    filepath = "{0}{1}.nc".format(filedir,min_date.strftime("%Y/{0}_%Y_%m_%d".format(dataset_id)))
-    directory = os.path.dirname(filepath)
-    if not os.path.exists(directory):
-      os.makedirs(directory)
-    configpath = "{0}/{1}.part".format(dataset_dir,dataset_id)
-    directory = os.path.dirname(configpath)
-    if not os.path.exists(directory):
+def ensure_dir(directory):
+    # months run in parallel create the same folders, the loser of the race finds them made
+    try:
       os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
 
+def make_dirs(filepath,configpath):
+    ensure_dir(os.path.dirname(filepath))
+    ensure_dir(os.path.dirname(configpath))
+
+def dataset_xml(xds,dataset_id,filedir):
+    """
+    The ERDDAP dataset definition of an aggregation. Adds the time
+    attributes of the *_time variables to xds on the way.
+    """
     erdds = [
     """<dataset type="EDDTableFromNcFiles" datasetID="{0}" active="true">
     <reloadEveryNMinutes>1440</reloadEveryNMinutes>
@@ -192,12 +507,239 @@ def aggregate(ts,min_date,period,data_dir,dataset_dir,constraints):
       erdds.append("    </dataVariable>")
 
     erdds.append("</dataset>")
+    return "\n".join(erdds)
+
+def write_part(configpath,xml):
+    # several months of one dataset may be written at once
+    with metrics.stage("write_part"):
+      tmpconfig = "{0}.{1}.tmp".format(configpath,os.getpid())
+      with open(tmpconfig,"w") as out:
+         out.write(xml)
+      shutil.move(tmpconfig,configpath)
+
+# the buckets of one series in a compressed chunk, a day of minutely rows, a month of the others
+CHUNK_BUCKETS = {"minutely": 1440, "hourly": 744, "daily": 31, "weekly": 6, "monthly": 1}
+
+def float_columns(ts,columns):
+    """
+    The columns aggregated from variables the source stores as float,
+    whose precision float32 already bounds.
+    """
+    answer = []
+    for v in ts.variables():
+      if v["type"] != "float":
+        continue
+      for name in [v["lcname"]] + ["{0}_{1}".format(agg,v["lcname"]) for agg in ["mean","stdev","minimum","maximum"]]:
+        if name in columns:
+          answer.append(name)
+    return answer
+
+def chunk_length(ts,df,period):
+    """
+    The rows of a chunk holding CHUNK_BUCKETS of every series, the rows
+    being in time order.
+    """
+    keys = [v["lcname"] for v in ts.variables() if v["identifier"] and v["lcname"] in df]
+    series = len(df.drop_duplicates(keys)) if keys else 1
+    return max(1,min(len(df),CHUNK_BUCKETS[period]*series))
+
+def compressed_encoding(xds,encoding,compression,chunk):
+    """
+    Adds zlib at level compression with the shuffle filter, in chunks of
+    chunk rows, to the encoding of every variable of xds. The index is
+    left contiguous.
+    """
+    for name, variable in xds.variables.items():
+      if name == "index":
+        encoding[name] = {"contiguous": True}
+        continue
+      e = encoding.setdefault(name,{})
+      e.update({"zlib": True, "complevel": compression, "shuffle": True})
+      if variable.dtype.kind != "O":
+        e["chunksizes"] = (chunk,)
+    return encoding
+
+def write_aggregation(ts,df,min_date,period,data_dir,dataset_dir,compression=None,float32=False):
+    if float32:
+      for column in float_columns(ts,df.columns):
+        df[column] = df[column].astype(np.float32)
+    if compression:
+      # in time order, so a chunk holds a stretch of time of every series
+      df = df.sort_values("time",kind="mergesort").reset_index(drop=True)
+    # create xarray Dataset from Pandas DataFrame
+    encoding = parse_times(df)
+    xds = describe(ts,df,period)
+    dataset_id, filedir, filepath, configpath = output_paths(ts,min_date,period,data_dir,dataset_dir)
+    make_dirs(filepath,configpath)
+    xml = dataset_xml(xds,dataset_id,filedir)
+    if compression:
+      encoding = compressed_encoding(xds,encoding,compression,chunk_length(ts,df,period))
+
+    with metrics.stage("to_netcdf"):
+      xds.to_netcdf("{0}.tmp".format(filepath),encoding=encoding)
+      shutil.move("{0}.tmp".format(filepath),filepath)
+    write_part(configpath,xml)
+
+def encode_strings(values):
+    return values.fillna("").map(lambda v: v.encode("utf-8") if isinstance(v,unicode) else str(v))
+
+def chunk_schema(chunks):
+    """
+    A pass over the chunks settling what the whole DataFrame would have
+    made of each column: its dtype, and for the string columns either the
+    longest string, as utf-8 bytes, or None for unicode ones, which xarray
+    writes as variable length strings. Also counts the rows.
+    """
+    kinds = {}
+    nulls = set()
+    strlens = {}
+    columns = None
+    rows = 0
+    for df in chunks():
+      parse_times(df)
+      rows += len(df)
+      if columns is None:
+        columns = list(df.columns)
+      for column in df:
+        values = df[column]
+        missing = values.isnull()
+        if missing.any():
+          nulls.add(column)
+        if missing.all():
+          continue
+        kinds.setdefault(column,set()).add(values.dtype.kind)
+        if values.dtype.kind == "O" and isinstance(values.dropna().iloc[0],unicode):
+          strlens[column] = None
+        elif values.dtype.kind == "O" and strlens.get(column,1) is not None:
+          strlens[column] = max(strlens.get(column,1),encode_strings(values).map(len).max())
+    if columns is None:
+      return None
+    dtypes = {}
+    for column in columns:
+      seen = kinds.get(column,set())
+      if "O" in seen:
+        dtypes[column] = np.dtype(object)
+      elif "M" in seen or column.endswith("time"):
+        dtypes[column] = np.dtype("datetime64[ns]")
+      elif seen and seen <= set("iu") and column not in nulls:
+        dtypes[column] = np.dtype(np.int64)
+      else:
+        dtypes[column] = np.dtype(np.float64)
+    return columns, dtypes, nulls, strlens, rows
+
+def write_chunks(ts,chunks,min_date,period,data_dir,dataset_dir,chunk_rows=10000,compression=None,float32=False):
+    """
+    write_aggregation for months too big to hold at once. chunks() yields
+    the aggregated rows as DataFrames in time order, and is called twice:
+    once to settle the schema, then to append each chunk to the netcdf
+    file along an unlimited index dimension, in compressed chunks of
+    chunk_rows. The writing holds a chunk at a time, what the chunks come
+    from is up to the engine (see stream_dataframes and sqlite_dataframes).
+    With compression the zlib level is set and the index dimension has
+    the size counted in the first pass.
+    """
+    with metrics.stage("scan_chunks"):
+      schema = chunk_schema(chunks)
+    if schema is None:
+      return
+    columns, dtypes, nulls, strlens, total = schema
+    if float32:
+      for column in float_columns(ts,columns):
+        if dtypes[column].kind == "f":
+          dtypes[column] = np.dtype(np.float32)
+    options = {"zlib": True, "complevel": compression or 4, "shuffle": True}
+    # a chunk can't be longer than a fixed dimension
+    chunk = min(chunk_rows,max(total,1)) if compression else chunk_rows
+    empty = pd.DataFrame(dict((c,pd.Series([],dtype=dtypes[c])) for c in columns),columns=columns)
+    xds = describe(ts,empty,period)
+    dataset_id, filedir, filepath, configpath = output_paths(ts,min_date,period,data_dir,dataset_dir)
+    make_dirs(filepath,configpath)
+    xml = dataset_xml(xds,dataset_id,filedir)
+
+    with metrics.stage("to_netcdf"):
+      tmpfile = "{0}.tmp".format(filepath)
+      nc = netCDF4.Dataset(tmpfile,"w",format="NETCDF4")
+      try:
+        nc.setncatts(dict(xds.attrs))
+        if compression:
+          nc.createDimension("index",total)
+          nc.createVariable("index","i8",("index",),contiguous=True)
+        else:
+          nc.createDimension("index",None)
+          nc.createVariable("index","i8",("index",),zlib=True,chunksizes=(chunk_rows,))
+        for column in columns:
+          dtype = dtypes[column]
+          attributes = dict(xds[column].attrs)
+          if dtype.kind == "O" and column in strlens and strlens[column] is None:
+            var = nc.createVariable(column,str,("index",))
+          elif dtype.kind == "O":
+            dimension = "string{0}".format(strlens.get(column,1))
+            if dimension not in nc.dimensions:
+              nc.createDimension(dimension,strlens.get(column,1))
+            var = nc.createVariable(column,"S1",("index",dimension),
+                                    chunksizes=(chunk,strlens.get(column,1)),**options)
+          elif dtype.kind == "M":
+            # as xarray encodes them, floats only when there are missing times
+            kind = "f8" if column in nulls else "i8"
+            var = nc.createVariable(column,kind,("index",),chunksizes=(chunk,),
+                                    fill_value=np.nan if kind == "f8" else None,**options)
+            attributes.update({"units": "seconds since 1970-01-01T00:00:00+00:00", "calendar": "proleptic_gregorian"})
+          else:
+            var = nc.createVariable(column,dtype,("index",),chunksizes=(chunk,),
+                                    fill_value=np.nan if dtype.kind == "f" else None,**options)
+          var.setncatts(attributes)
+        n = 0
+        for df in chunks():
+          parse_times(df)
+          rows = slice(n,n+len(df))
+          nc.variables["index"][rows] = np.arange(n,n+len(df))
+          for column in columns:
+            dtype = dtypes[column]
+            values = df[column]
+            if dtype.kind == "O" and column in strlens and strlens[column] is None:
+              nc.variables[column][rows] = values.fillna(u"").values.astype(object)
+            elif dtype.kind == "O":
+              width = strlens.get(column,1)
+              nc.variables[column][rows] = netCDF4.stringtochar(np.array(encode_strings(values).tolist(),dtype="S{0}".format(width)))
+            elif dtype.kind == "M":
+              seconds = pd.to_datetime(values).values.astype("datetime64[s]").astype(np.int64)
+              if column in nulls:
+                seconds = np.where(values.isnull().values,np.nan,seconds)
+              nc.variables[column][rows] = seconds
+            else:
+              nc.variables[column][rows] = values.values.astype(dtype)
+          n += len(df)
+      finally:
+        nc.close()
+      shutil.move(tmpfile,filepath)
+    write_part(configpath,xml)
 
-    xds.to_netcdf("{0}.tmp".format(filepath),encoding=encoding)
-    shutil.move("{0}.tmp".format(filepath),filepath)
-    with open(configpath,"w") as out:
-       out.write("\n".join(erdds))
 
+@contextmanager
+def instrumented(metrics_path=None,profile_path=None):
+    """
+    Sends the metrics to metrics_path and optionally profiles the block
+    with cProfile.
+    """
+    out = None
+    if metrics_path == "-":
+      metrics.configure(sys.stderr)
+    elif metrics_path:
+      out = open(metrics_path,"a")
+      metrics.configure(out)
+    profiler = None
+    if profile_path:
+      profiler = cProfile.Profile()
+      profiler.enable()
+    try:
+      yield
+    finally:
+      if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+      metrics.configure(None)
+      if out is not None:
+        out.close()
 
 def valid_date(s):
     if len(s) == len("2016-01"):
@@ -210,19 +752,78 @@ def valid_date(s):
     msg = "Not a valid date in format YYYY-MM: '{0}'.".format(s)
     raise argparse.ArgumentTypeError(msg)
 
+def valid_periods(s):
+    if s == "all":
+      return PERIODS
+    periods = s.split(",")
+    for period in periods:
+      if period not in PERIODS:
+        msg = "Not a valid period: '{0}', choose from {1} or all.".format(period,", ".join(PERIODS))
+        raise argparse.ArgumentTypeError(msg)
+    return [p for p in PERIODS if p in periods]
+
+# the keyword options of aggregate, named as the command line options that set them
+AGGREGATE_OPTIONS = ["data_dir","dataset_dir","constraints","engine","incremental","chunk_rows","partition",
+                     "compression","float32","skip_unchanged_source"]
+
+def add_aggregate_arguments(parser):
+    """
+    Adds the options of the download and of the aggregation shared by
+    aggrerddap.py, backfill.py and worker.py, but the constraints.
+    """
+    parser.add_argument("--data_dir", help="Folder containing the netcdf files", default="/opt/aggrerddap/data")
+    parser.add_argument("--dataset_dir", help="Folder containing the erdap dataset files", default="/opt/aggrerddap/config")
+    parser.add_argument("--engine", help="How the aggregations are computed", choices=sorted(engines.keys()), default="stream")
+    parser.add_argument("--incremental", help="Only aggregate rows newer than the previous run, using the bucket states saved next to the netcdf files (stream engine)", action="store_true")
+    parser.add_argument("--chunk_rows", help="Write the netcdf files a chunk of this many rows at a time, to bound the memory used by big months, and size the download windows to about as many rows unless --target_rows or --target_window_size is given", type=int)
+    parser.add_argument("--partition", help="Write a netcdf file per day, week or month of the month, only the files whose rows changed are written again", choices=PARTITIONS, default="month")
+    parser.add_argument("--compression", help="Compress the netcdf variables with zlib at this level (1-9) and the shuffle filter, in chunks of a day of minutely rows or a month of the others", type=int, choices=range(1,10), metavar="LEVEL")
+    parser.add_argument("--float32", help="Write the aggregations of variables the source stores as float as float32", action="store_true")
+    parser.add_argument("--skip_unchanged_source", help="Ask the server for the number of values and the first and last time of the month before downloading it, and skip the month when its files were written from a source with the same counts and times", action="store_true")
+    parser.add_argument("--workers", help="Number of download windows fetched concurrently per month", type=int, default=1)
+    parser.add_argument("--transport", help="Download the windows as csv, or as .nc read straight into arrays (stream engine)", choices=TRANSPORTS, default="csv")
+    parser.add_argument("--target_rows", help="Size the download windows to about this many rows each, from the density of the earlier windows", type=int)
+    parser.add_argument("--target_window_size", help="Size the download windows to about this many MB each", type=float)
+    parser.add_argument("--timeout", help="Seconds to wait for the server before a request is retried, with a target set a window that times out is split in two", type=float, default=300)
+    parser.add_argument("--http_retries", help="Number of times a request that fails with a connection error, a timeout or a 5xx is retried, with exponential backoff", type=int, default=3)
+    parser.add_argument("--cache_dir", help="Folder for cached ERDDAP responses, no caching if not given")
+    parser.add_argument("--cache_size", help="Maximum size of the response cache in MB", type=int, default=1024)
+    parser.add_argument("--metrics", help="Append stage timings and per window metrics as JSON lines to this file, - for stderr")
+
+def check_aggregate_arguments(parser,args):
+    if args.transport == "nc" and netCDF4 is None:
+      parser.error("the nc transport needs netCDF4")
+    if args.chunk_rows and netCDF4 is None:
+      parser.error("--chunk_rows needs netCDF4")
+    if args.chunk_rows and args.target_rows is None and args.target_window_size is None:
+      # the download windows are bounded too, else a month comes in one response
+      args.target_rows = args.chunk_rows
+
+def erddap_from_args(args):
+    return new_erddap(args.workers,args.cache_dir,args.cache_size,args.target_rows,args.target_window_size,args.timeout,
+                      args.transport,args.http_retries)
+
+def aggregate_options(args):
+    """
+    The keyword options of aggregate given on the command line.
+    """
+    return dict((name,getattr(args,name)) for name in AGGREGATE_OPTIONS)
+
 if __name__ == "__main__":
    parser = argparse.ArgumentParser()
    parser.add_argument("series",help="The timeseries identifier in erddap")
    parser.add_argument("startdate", help="Start date format YYYY-MM",  type=valid_date)
-   parser.add_argument("period", choices=['minutely','hourly','daily','monthly'])
-   parser.add_argument("--data_dir", help="Folder containing the netcdf files", default="/opt/aggrerddap/data")
-   parser.add_argument("--dataset_dir", help="Folder containing the erdap dataset files", default="/opt/aggrerddap/config")
+   parser.add_argument("period", help="Comma separated list of periods from {0}, or all".format(",".join(PERIODS)), type=valid_periods)
+   add_aggregate_arguments(parser)
+   parser.add_argument("--profile", help="Write cProfile statistics of the run to this file")
    parser.add_argument('constraints', nargs = '*', help = 'any constraints included in the query eg, "temp<=25"')
    args = parser.parse_args()
-   erddap = new_erddap()
-   timeseries = {ts.id: ts for ts in erddap.timeseries()}
-   if(args.series not in timeseries):
-     print("unknown timeseries {0}, try one of these: [{1}]".format(args.series, ", ".join(timeseries.keys())))
-     sys.exit(2)
-   min_date = date(args.startdate.year,args.startdate.month,args.startdate.day)
-   aggregate(timeseries[args.series],min_date,args.period,args.data_dir,args.dataset_dir,args.constraints)
+   check_aggregate_arguments(parser,args)
+   with instrumented(args.metrics,args.profile):
+     erddap = erddap_from_args(args)
+     timeseries = {ts.id: ts for ts in erddap.timeseries()}
+     if(args.series not in timeseries):
+       print("unknown timeseries {0}, try one of these: [{1}]".format(args.series, ", ".join(timeseries.keys())))
+       sys.exit(2)
+     min_date = date(args.startdate.year,args.startdate.month,args.startdate.day)
+     aggregate(timeseries[args.series],min_date,args.period,**aggregate_options(args))
@@ -0,0 +1,138 @@
+from __future__ import print_function
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from urlparse import urlparse
+from erddap import erddap
+import threading
+
+class host_limited():
+  """
+  Wraps a requests.Session (or an http_cache) so at most per_host
+  requests to any one host are in flight at a time, whichever thread
+  makes them. A streamed body is read after its slot is given back.
+  """
+  def __init__(self,session,per_host=4):
+    self.session = session
+    self.per_host = per_host
+    self.lock = threading.Lock()
+    self.semaphores = {}
+
+  def semaphore(self,url):
+    host = urlparse(url).netloc
+    with self.lock:
+      if host not in self.semaphores:
+        self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+      return self.semaphores[host]
+
+  def get(self,url,**kwargs):
+    with self.semaphore(url):
+      return self.session.get(url,**kwargs)
+
+class async_timeseries():
+  """
+  A timeseries whose metadata and data come back as futures, run on the
+  pool of its async_erddap.
+  """
+  def __init__(self,ts,client):
+    self.ts = ts
+    self.client = client
+    self.id = ts.id
+
+  def metadata(self):
+    return self.client.submit(self.ts.metadata)
+
+  def summary(self):
+    return self.client.submit(self.ts.summary)
+
+  def variables(self):
+    return self.client.submit(self.ts.variables)
+
+  def min_time(self):
+    return self.client.submit(self.ts.min_time)
+
+  def batches(self,callback,min_date=None,max_date=None,constraints=[]):
+    """
+    Calls callback(df) with each DataFrame timeseries.batches() would
+    yield, in order, and returns a future of the number of rows, resolved
+    after the last window. Each window is its own task on the pool, so a
+    series holds no thread while it waits for its turn.
+    """
+    ts = self.ts
+    done = Future()
+    rows = [0]
+
+    def run(fn,*args):
+      try:
+        fn(*args)
+      except Exception as e:
+        done.set_exception(e)
+
+    def start():
+      planner = ts.windows(min_date,max_date)
+      fetch = partial(ts.get_batch_window,ts.window_url(constraints),ts.window_url(constraints,"nc"),planner)
+      step(planner,iter(planner),fetch)
+
+    def step(planner,windows,fetch):
+      window = next(windows,None)
+      if window is None:
+        done.set_result(rows[0])
+        return
+      df = ts.read_window(planner,*fetch(window))
+      if df is not None:
+        rows[0] += len(df)
+        callback(df)
+      self.client.submit(run,step,planner,windows,fetch)
+
+    self.client.submit(run,start)
+    return done
+
+  def streams(self,periods,min_date=None,max_date=None,constraints=[]):
+    """
+    The future of a stream_table per period fed with every batch, as the
+    stream engine of aggrerddap does, or of [] when there are no rows.
+    """
+    answer = Future()
+    streams = []
+
+    def feed(df):
+      if not streams:
+        streams.extend([self.ts.stream(period) for period in periods])
+      df = streams[0].prepare_batch(df)
+      for stream in streams:
+        stream.add_batch(df)
+
+    def finish(f):
+      if f.exception() is not None:
+        answer.set_exception(f.exception())
+      else:
+        answer.set_result(streams)
+
+    self.batches(feed,min_date,max_date,constraints).add_done_callback(finish)
+    return answer
+
+class async_erddap():
+  """
+  A futures based erddap client for driving many timeseries from one
+  process. Every request runs on one shared pool of `workers` threads,
+  with at most per_host of them talking to any one host, rather than a
+  thread or a pool per series. The other options are those of erddap.
+  """
+  def __init__(self,base_url,workers=16,per_host=4,**options):
+    self.erddap = erddap(base_url,workers=per_host,**options)
+    self.erddap.session = host_limited(self.erddap.session,per_host)
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+
+  def submit(self,fn,*args,**kwargs):
+    return self.executor.submit(fn,*args,**kwargs)
+
+  def timeseries(self):
+    return self.submit(lambda: [async_timeseries(ts,self) for ts in self.erddap.timeseries()])
+
+  def close(self):
+    self.executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*exc):
+    self.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from aggrerddap import add_aggregate_arguments, aggregate, aggregate_options, check_aggregate_arguments, erddap_from_args, instrumented, nextmonth, valid_date, valid_periods, output_exists, PERIODS
+from datetime import date
+from multiprocessing import Pool, cpu_count
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import traceback
+
+# set before the pool forks, so every worker shares the metadata loaded once
+_erddap = None
+_timeseries = {}
+_options = {}
+
+def months(start,end):
+  month = date(start.year,start.month,1)
+  end = date(end.year,end.month,1)
+  while month <= end:
+    yield month
+    month = nextmonth(month)
+
+def is_done(ts,month,periods,data_dir,dataset_dir):
+  for period in periods:
+    if not output_exists(ts,month,period,data_dir,dataset_dir):
+      return False
+  return True
+
+def select_series(timeseries,names,match=None,institution=None):
+  """
+  The timeseries named, or without names those of the whole catalog whose
+  id matches the regex `match` and whose institution contains
+  `institution` (ignoring case).
+  """
+  if names:
+    return [timeseries[name] for name in names]
+  answer = []
+  for series in sorted(timeseries):
+    ts = timeseries[series]
+    if match and not re.search(match,series):
+      continue
+    if institution and institution.lower() not in (ts.info.get("institution") or "").lower():
+      continue
+    answer.append(ts)
+  return answer
+
+def catalog_state_path(data_dir):
+  return os.path.join(data_dir,"catalog_state.json")
+
+def load_catalog_state(path):
+  """
+  The maxTime of each dataset when each of its months was last aggregated
+  without failures, as {dataset: {YYYY-MM: maxTime}}.
+  """
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    state = json.load(f)
+  # an older state held one maxTime per dataset, whatever months were run
+  return dict((k,v) for k, v in state.items() if isinstance(v,dict))
+
+def save_catalog_state(path,state):
+  directory = os.path.dirname(path)
+  if directory and not os.path.exists(directory):
+    os.makedirs(directory)
+  tmp = "{0}.{1}.tmp".format(path,os.getpid())
+  with open(tmp,"w") as out:
+    json.dump(state,out,indent=1,sort_keys=True)
+  shutil.move(tmp,path)
+
+def unchanged(ts,month,state):
+  max_time = ts.info.get("maxTime")
+  return max_time is not None and state.get(ts.id,{}).get(month.strftime("%Y-%m")) == max_time
+
+def init_worker():
+  _erddap.reset_session()
+
+def run_job(job):
+  series, month = job
+  o = _options
+  for attempt in range(o["retries"]+1):
+    try:
+      aggregate(_timeseries[series],month,o["periods"],**o["aggregate"])
+      return series, month, None
+    except Exception:
+      error = traceback.format_exc()
+  return series, month, error
+
+def backfill(jobs,processes):
+  """
+  Runs the (series, month) jobs on a pool of processes and returns the
+  jobs that failed with their tracebacks.
+  """
+  failed = []
+  pool = Pool(processes,initializer=init_worker)
+  try:
+    for series, month, error in pool.imap_unordered(run_job,jobs):
+      if error is None:
+        print("done {0} {1:%Y-%m}".format(series,month))
+      else:
+        print("failed {0} {1:%Y-%m}\n{2}".format(series,month,error),file=sys.stderr)
+        failed.append((series,month,error))
+  finally:
+    pool.close()
+    pool.join()
+  return failed
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Aggregate a range of months for several timeseries, or for the whole catalog")
+   parser.add_argument("series",nargs="*",help="The timeseries identifiers in erddap")
+   parser.add_argument("--all", help="Aggregate every TimeSeries and Point dataset in the catalog", action="store_true")
+   parser.add_argument("--match", help="Aggregate the datasets of the catalog whose identifier matches this regular expression")
+   parser.add_argument("--institution", help="Aggregate the datasets of the catalog whose institution contains this text")
+   parser.add_argument("--skip_unchanged", help="Skip the months of each dataset whose maxTime hasn't changed since they were last aggregated without failures", action="store_true")
+   parser.add_argument("--start", help="First month, format YYYY-MM, default this month", type=valid_date, default=date.today().replace(day=1))
+   parser.add_argument("--end", help="Last month, format YYYY-MM, default this month", type=valid_date, default=date.today().replace(day=1))
+   parser.add_argument("--period", help="Comma separated list of periods from {0}, or all".format(",".join(PERIODS)), type=valid_periods, default=PERIODS)
+   add_aggregate_arguments(parser)
+   parser.add_argument("--processes", help="Number of months aggregated in parallel", type=int, default=cpu_count())
+   parser.add_argument("--retries", help="Number of times a failed month is retried", type=int, default=0)
+   parser.add_argument("--skip_existing", help="Skip months whose netcdf files exist for every period", action="store_true")
+   parser.add_argument("--constraint", dest="constraints", action="append", default=[], help='a constraint included in the query eg, "temp<=25", may be repeated')
+   args = parser.parse_args()
+   if not (args.series or args.all or args.match or args.institution):
+     parser.error("give the series to aggregate, or select them from the catalog with --all, --match or --institution")
+   if args.series and (args.all or args.match or args.institution):
+     parser.error("give either series or --all/--match/--institution, not both")
+   check_aggregate_arguments(parser,args)
+
+   _erddap = erddap_from_args(args)
+   timeseries = {ts.id: ts for ts in _erddap.timeseries()}
+   unknown = [s for s in args.series if s not in timeseries]
+   if len(unknown):
+     print("unknown timeseries {0}, try one of these: [{1}]".format(", ".join(unknown), ", ".join(timeseries.keys())))
+     sys.exit(2)
+   state_file = catalog_state_path(args.data_dir)
+   state = load_catalog_state(state_file)
+   selected = []
+   for ts in select_series(timeseries,args.series,args.match,args.institution):
+     if args.skip_unchanged and all([unchanged(ts,month,state) for month in months(args.start,args.end)]):
+       print("unchanged {0}, maxTime {1}".format(ts.id,ts.info.get("maxTime")))
+       continue
+     # resolve the metadata once, the forked workers inherit it
+     ts.variables()
+     ts.summary()
+     _timeseries[ts.id] = ts
+     selected.append(ts.id)
+   _options.update({
+     "periods": args.period,
+     "retries": args.retries,
+     "aggregate": aggregate_options(args),
+   })
+
+   jobs = []
+   for series in selected:
+     for month in months(args.start,args.end):
+       if args.skip_existing and is_done(_timeseries[series],month,args.period,args.data_dir,args.dataset_dir):
+         continue
+       if args.skip_unchanged and unchanged(_timeseries[series],month,state):
+         continue
+       jobs.append((series,month))
+
+   # the workers inherit the metrics file
+   with instrumented(args.metrics):
+     failed = backfill(jobs,args.processes)
+   # the months run without failure count as aggregated up to the maxTime of their dataset
+   failed_jobs = set([(series,month) for series, month, error in failed])
+   for series, month in jobs:
+     max_time = _timeseries[series].info.get("maxTime")
+     if (series,month) not in failed_jobs and max_time is not None:
+       state.setdefault(series,{})[month.strftime("%Y-%m")] = max_time
+   save_catalog_state(state_file,state)
+   if len(failed):
+     print("{0} of {1} months failed:".format(len(failed),len(jobs)),file=sys.stderr)
+     for series, month, error in sorted(failed):
+       print("  {0} {1:%Y-%m}".format(series,month),file=sys.stderr)
+     print("rerun with --skip_existing to retry only the months without output",file=sys.stderr)
+     sys.exit(1)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+A local stand-in for an ERDDAP server, serving allDatasets.json, the
+info/<id>/index.json metadata and synthetic tabledap .csv/.json/.nc
+queries for a single TimeSeries dataset, with orderByMin, orderByMinMax
+and orderByCount.
+"""
+from __future__ import print_function
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+from multiprocessing import Process, Queue
+from urlparse import urlparse
+# imported up front, strptime's lazy import isn't thread safe in python 2
+import _strptime
+import argparse
+import calendar
+import json
+import netCDF4
+import numpy as np
+import os
+import random
+import tempfile
+import urllib
+
+DATASET_ID = "bench_ctd"
+START = "2017-01-01T00:00:00Z"
+
+def parse_time(s):
+  return calendar.timegm(datetime.strptime(s,"%Y-%m-%dT%H:%M:%SZ").timetuple())
+
+def format_time(t):
+  return datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class dataset():
+  """
+  A synthetic dataset of `stations` stations reporting `columns` variables
+  of type `kind` (double or float) every `step` seconds, with
+  `nan_density` of the values NaN.
+  """
+  def __init__(self,columns=10,step=60,stations=1,nan_density=0.1,kind="double"):
+    self.columns = columns
+    self.step = step
+    self.stations = ["S{0}".format(n) for n in range(stations)]
+    self.nan_density = nan_density
+    self.variables = [
+      ("station_id","String",{"ioos_category": "Identifier", "long_name": "Station"}),
+      ("time","double",{"axis": "T", "ioos_category": "Time", "units": "seconds since 1970-01-01T00:00:00Z"}),
+      ("latitude","double",{"axis": "Y", "units": "degrees_north"}),
+      ("longitude","double",{"axis": "X", "units": "degrees_east"}),
+      ("qcFlag","int",{"ioos_category": "Quality"}),
+    ]
+    for n in range(columns):
+      self.variables.append(("var{0}".format(n),kind,{"long_name": "Variable {0}".format(n), "units": "1"}))
+
+  def metadata(self):
+    rows = [
+      ["attribute","NC_GLOBAL","title","String","Benchmark CTD"],
+      ["attribute","NC_GLOBAL","time_coverage_start","String",START],
+    ]
+    for name, kind, attributes in self.variables:
+      rows.append(["variable",name,"",kind,""])
+      for k, v in sorted(attributes.items()):
+        rows.append(["attribute",name,k,"String",v])
+    return {"table": {"columnNames": ["Row Type","Variable Name","Attribute Name","Data Type","Value"], "rows": rows}}
+
+  def values(self,t,station):
+    r = random.Random(t * 31 + hash(station))
+    answer = {"station_id": station, "time": format_time(t), "latitude": "53.2", "longitude": "-9.1",
+              "qcFlag": str(r.randint(0,4))}
+    for n in range(self.columns):
+      if r.random() < self.nan_density:
+        answer["var{0}".format(n)] = "NaN"
+      else:
+        answer["var{0}".format(n)] = repr(r.gauss(10,2))
+    return answer
+
+  def rows(self,start,end):
+    t = max(start,parse_time(START))
+    t = ((t + self.step - 1) // self.step) * self.step
+    while t < end:
+      for station in self.stations:
+        yield self.values(t,station)
+      t += self.step
+
+def netcdf(data,wanted,rows):
+  """
+  The bytes of a tabledap .nc response: one "row" dimension, strings as
+  char arrays and times as seconds since 1970, like ERDDAP writes them.
+  """
+  kinds = dict((n,(k,a)) for n, k, a in data.variables)
+  fd, path = tempfile.mkstemp(suffix=".nc")
+  os.close(fd)
+  try:
+    nc = netCDF4.Dataset(path,"w",format="NETCDF3_CLASSIC")
+    nc.createDimension("row",len(rows))
+    for name in wanted:
+      kind, attributes = kinds[name]
+      values = [o[name] for o in rows]
+      if kind == "String":
+        strlen = max([len(v) for v in values] + [1])
+        nc.createDimension(name+"_strlen",strlen)
+        var = nc.createVariable(name,"S1",("row",name+"_strlen"))
+        var[:] = netCDF4.stringtochar(np.array(values,dtype="S{0}".format(strlen)))
+      elif name == "time":
+        var = nc.createVariable(name,"f8",("row",))
+        var[:] = np.array([parse_time(v) for v in values],dtype=np.float64)
+      else:
+        var = nc.createVariable(name,{"int": "i4", "float": "f4"}.get(kind,"f8"),("row",))
+        var[:] = np.array([float(v) for v in values]).astype(var.dtype)
+      var.setncatts(attributes)
+    nc.close()
+    with open(path,"rb") as f:
+      return f.read()
+  finally:
+    os.remove(path)
+
+def time_bounds(constraints):
+  start, end = 0, 2**40
+  for c in constraints:
+    if c.startswith("time>="):
+      start = max(start,parse_time(c[6:]))
+    elif c.startswith("time>"):
+      start = max(start,parse_time(c[5:])+1)
+    elif c.startswith("time<="):
+      end = min(end,parse_time(c[6:])+1)
+    elif c.startswith("time<"):
+      end = min(end,parse_time(c[5:]))
+  return start, end
+
+class handler(BaseHTTPRequestHandler):
+  def log_message(self,*args):
+    pass
+
+  def send(self,body,content_type):
+    self.send_response(200)
+    self.send_header("Content-Type",content_type)
+    self.send_header("Content-Length",str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    data = self.server.dataset
+    url = urlparse(self.path)
+    query = [urllib.unquote_plus(q) for q in url.query.split("&")]
+    if url.path.endswith("/allDatasets.json"):
+      rows = []
+      if '"TimeSeries"' in url.query or "%22TimeSeries%22" in url.query:
+        base = "http://{0}:{1}/erddap".format(*self.server.server_address)
+        rows.append([DATASET_ID,"{0}/info/{1}/index".format(base,DATASET_ID),
+                     "{0}/tabledap/{1}".format(base,DATASET_ID),START,"Benchmark"])
+      return self.send(json.dumps({"table": {"columnNames": ["datasetID","metadata","tabledap","minTime","institution"], "rows": rows}}),"application/json")
+    if url.path.endswith("/index.json"):
+      return self.send(json.dumps(data.metadata()),"application/json")
+    if url.path.endswith(".csv") or url.path.endswith(".json") or url.path.endswith(".nc"):
+      names = [n for n, k, a in data.variables]
+      wanted = [c.strip('"') for c in query[0].split(",") if c.strip('"') in names] or names
+      start, end = time_bounds(query[1:])
+      rows = data.rows(start,end)
+      if any(q.startswith("orderByCount") for q in query):
+        rows = list(rows)
+        rows = [dict((w,sum([o[w] not in ["NaN",""] for o in rows])) for w in wanted)] if rows else []
+      elif any(q.startswith("orderByMinMax") for q in query):
+        rows = list(rows)
+        rows = rows[:1] + rows[-1:] if len(rows) > 1 else rows
+      elif any(q.startswith("orderByMin") for q in query):
+        rows = [o for o in rows][:1]
+      if url.path.endswith(".nc"):
+        rows = list(rows)
+        if not len(rows):
+          # what ERDDAP answers for "Your query produced no matching results"
+          self.send_response(404)
+          self.end_headers()
+          return
+        return self.send(netcdf(data,wanted,rows),"application/x-netcdf")
+      if url.path.endswith(".json"):
+        body = json.dumps({"table": {"columnNames": wanted, "rows": [[o[w] for w in wanted] for o in rows]}})
+        return self.send(body,"application/json")
+      units = dict((n,a.get("units","")) for n, k, a in data.variables)
+      lines = [",".join(wanted),",".join([units[w] for w in wanted])]
+      for o in rows:
+        lines.append(",".join([str(o[w]) for w in wanted]))
+      return self.send("\n".join(lines)+"\n","text/csv")
+    self.send_response(404)
+    self.end_headers()
+
+class server(ThreadingMixIn,HTTPServer):
+  daemon_threads = True
+  def __init__(self,address,data):
+    HTTPServer.__init__(self,address,handler)
+    self.dataset = data
+
+def _serve(data,port,ready):
+  s = server(("127.0.0.1",port),data)
+  ready.put(s.server_address[1])
+  s.serve_forever()
+
+def start(data,port=0):
+  """
+  Serves `data` from a separate process, so generating the responses does
+  not compete with the client being measured. Returns (process, base url).
+  """
+  ready = Queue()
+  p = Process(target=_serve,args=(data,port,ready))
+  p.daemon = True
+  p.start()
+  return p, "http://127.0.0.1:{0}/erddap".format(ready.get())
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--columns", type=int, default=10)
+  parser.add_argument("--step", type=int, default=60, help="Seconds between rows")
+  parser.add_argument("--stations", type=int, default=1)
+  parser.add_argument("--nan_density", type=float, default=0.1)
+  parser.add_argument("--kind", choices=["double","float"], default="double", help="Type of the variables")
+  args = parser.parse_args()
+  s = server(("127.0.0.1",args.port),dataset(args.columns,args.step,args.stations,args.nan_density,args.kind))
+  print("serving http://127.0.0.1:{0}/erddap".format(args.port))
+  s.serve_forever()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compares the netcdf encodings of write_aggregation on one aggregated
+month from a local fake ERDDAP server: the file size, the seconds to
+write it, to read every variable, to read the measures one column at a
+time and to read the first day of rows, for the default encoding and
+for zlib levels with and without float32.
+"""
+from __future__ import print_function
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from erddap import erddap
+from aggrerddap import nextmonth, output_paths, stream_dataframes, write_aggregation, valid_date, CHUNK_BUCKETS
+from datetime import date
+import fake_erddap
+import argparse
+import json
+import netCDF4
+import shutil
+import tempfile
+import time
+
+ENCODINGS = [
+  ("default", None, False),
+  ("zlib1", 1, False),
+  ("zlib4", 4, False),
+  ("zlib4_float32", 4, True),
+  ("zlib9_float32", 9, True),
+]
+
+def best(fn,repeat):
+  # the fastest of a few reads, the file is in the page cache after the first
+  seconds = []
+  for n in range(repeat):
+    start = time.time()
+    fn()
+    seconds.append(time.time() - start)
+  return min(seconds)
+
+def read_all(path):
+  with netCDF4.Dataset(path) as nc:
+    for v in nc.variables.values():
+      v[:]
+
+def read_columns(path):
+  with netCDF4.Dataset(path) as nc:
+    for name in nc.variables:
+      if name.startswith("mean_"):
+        nc.variables[name][:]
+
+def read_first_rows(path,rows):
+  with netCDF4.Dataset(path) as nc:
+    for v in nc.variables.values():
+      v[:rows]
+
+def benchmark(base_url,month,period,out_dir,repeat=5):
+  min_date = date(month.year,month.month,1)
+  ts = erddap(base_url).timeseries()[0]
+  # the library prints its urls, keep stdout for the json
+  stdout = sys.stdout
+  sys.stdout = sys.stderr
+  try:
+    df = stream_dataframes(ts,[period],min_date,nextmonth(min_date),[])[period]
+  finally:
+    sys.stdout = stdout
+  # a day of rows of every station, the rows are written in time order when compressed
+  day = CHUNK_BUCKETS[period] if period == "minutely" else len(df)
+  day = day * len(df["station_id"].unique())
+  results = {}
+  for name, compression, float32 in ENCODINGS:
+    data_dir = os.path.join(out_dir,name)
+    start = time.time()
+    write_aggregation(ts,df.copy(),min_date,period,data_dir,os.path.join(out_dir,"config"),compression,float32)
+    seconds = time.time() - start
+    path = output_paths(ts,min_date,period,data_dir,out_dir)[2]
+    results[name] = {
+      "bytes": os.path.getsize(path),
+      "write_seconds": seconds,
+      "read_all_seconds": best(lambda: read_all(path),repeat),
+      "read_columns_seconds": best(lambda: read_columns(path),repeat),
+      "read_first_day_seconds": best(lambda: read_first_rows(path,day),repeat),
+    }
+  return {"rows": len(df), "encodings": results}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--month", type=valid_date, default=valid_date("2017-11"), help="Month to aggregate, format YYYY-MM")
+  parser.add_argument("--period", default="minutely")
+  parser.add_argument("--columns", type=int, default=10)
+  parser.add_argument("--step", type=int, default=10, help="Seconds between rows")
+  parser.add_argument("--stations", type=int, default=2)
+  parser.add_argument("--nan_density", type=float, default=0.1)
+  parser.add_argument("--kind", choices=["double","float"], default="float", help="Type of the source variables")
+  parser.add_argument("--repeat", type=int, default=5, help="Reads of each file, the fastest is kept")
+  parser.add_argument("--output", help="Also write the results to this file")
+  args = parser.parse_args()
+
+  server, base_url = fake_erddap.start(fake_erddap.dataset(args.columns,args.step,args.stations,args.nan_density,args.kind))
+  out_dir = tempfile.mkdtemp()
+  try:
+    results = {
+      "parameters": {"month": args.month.strftime("%Y-%m"), "period": args.period, "columns": args.columns,
+                     "step": args.step, "stations": args.stations, "nan_density": args.nan_density, "kind": args.kind},
+      "results": benchmark(base_url,args.month,args.period,out_dir,args.repeat),
+    }
+  finally:
+    shutil.rmtree(out_dir)
+    server.terminate()
+  print(json.dumps(results,indent=2,sort_keys=True))
+  if args.output:
+    with open(args.output,"w") as out:
+      json.dump(results,out,indent=2,sort_keys=True)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Rows per second of loading synthetic timeseries.data() rows into the
+sqlite aggregation table, the original way (strftime period keys, batches
+of 1000, default pragmas) against the tuned way (epoch seconds and integer
+period buckets, a generator passed to executemany, tuned pragmas), and of
+loading the same rows as the timeseries.rows() tuples sqlite_dataframes
+uses.
+"""
+from __future__ import print_function
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from erddap import sqlite3_table, parse_iso_timestamp, PERIODS, PERIOD_FORMATS, format_epoch
+from aggrerddap import sqlite_connect
+import argparse
+import json
+import random
+import sqlite3
+import tempfile
+import time
+
+def variables(columns):
+  answer = [
+    {"name": "station_id", "lcname": "station_id", "type": "String", "cassandra_type": "text",
+     "identifier": True, "quality": False, "axis": False, "units": None},
+    {"name": "time", "lcname": "time", "type": "double", "cassandra_type": "timestamp",
+     "identifier": False, "quality": False, "axis": True, "units": None},
+  ]
+  for n in range(columns):
+    answer.append({"name": "var{0}".format(n), "lcname": "var{0}".format(n), "type": "double",
+                   "cassandra_type": "double", "identifier": False, "quality": False, "axis": False, "units": None})
+  return answer
+
+def rows(count,columns,nan_density):
+  r = random.Random(42)
+  start = 1509494400
+  for i in range(count):
+    o = {"station_id": "A", "time": format_epoch(start + i)}
+    for n in range(columns):
+      o["var{0}".format(n)] = None if r.random() < nan_density else r.random()
+    yield o
+
+def row_tuples(count,columns,nan_density):
+  names = [v["name"] for v in variables(columns)]
+  for o in rows(count,columns,nan_density):
+    yield tuple([o[n] for n in names])
+
+def legacy_tuplify(table,o):
+  mt = parse_iso_timestamp(o["time"])
+  for period in PERIODS:
+    o[period] = mt.strftime(PERIOD_FORMATS[period])
+  return tuple([o[v["name"]] for v in table.columns])
+
+def legacy_ingest(table,dbfile,data):
+  conn = sqlite3.connect(dbfile)
+  c = conn.cursor()
+  c.execute(table.sql_create_table())
+  query = table.sql_insert()
+  batch = []
+  i = 0
+  for o in data:
+    i = i + 1
+    batch.append(legacy_tuplify(table,o))
+    if i % 1000 == 0:
+      c.executemany(query,batch)
+      batch = []
+      if i % 500000 == 0:
+        conn.commit()
+  if len(batch):
+    c.executemany(query,batch)
+  conn.commit()
+  conn.close()
+
+def tuned_ingest(table,dbfile,data):
+  conn = sqlite_connect(dbfile)
+  c = conn.cursor()
+  c.execute(table.sql_create_table())
+  c.executemany(table.sql_insert(),table.tuples(data))
+  conn.commit()
+  conn.close()
+
+def tuple_ingest(table,dbfile,data):
+  conn = sqlite_connect(dbfile)
+  c = conn.cursor()
+  c.execute(table.sql_create_table())
+  c.executemany(table.sql_insert(),table.row_tuples(data,[v["name"] for v in variables(len(data[0])-2)]))
+  conn.commit()
+  conn.close()
+
+def measure(ingest,table,dbfile,count,columns,nan_density,make_rows=rows):
+  # the rows are built up front so only the ingest is timed
+  data = list(make_rows(count,columns,nan_density))
+  if dbfile != ":memory:" and os.path.exists(dbfile):
+    os.remove(dbfile)
+  start = time.time()
+  ingest(table,dbfile,data)
+  elapsed = time.time() - start
+  return {"seconds": elapsed, "rows_per_second": count / elapsed}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--rows", type=int, default=200000)
+  parser.add_argument("--columns", type=int, default=15)
+  parser.add_argument("--nan_density", type=float, default=0.1)
+  args = parser.parse_args()
+  table = sqlite3_table("bench",{},variables=variables(args.columns))
+  dbfile = os.path.join(tempfile.gettempdir(),"aggrerddap_bench.db")
+  results = {
+    "rows": args.rows,
+    "columns": args.columns,
+    "legacy": measure(legacy_ingest,table,dbfile,args.rows,args.columns,args.nan_density),
+    "tuned_file": measure(tuned_ingest,table,dbfile,args.rows,args.columns,args.nan_density),
+    "tuned_memory": measure(tuned_ingest,table,":memory:",args.rows,args.columns,args.nan_density),
+    "tuples_memory": measure(tuple_ingest,table,":memory:",args.rows,args.columns,args.nan_density,row_tuples),
+  }
+  os.remove(dbfile)
+  print(json.dumps(results,indent=2))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Times each stage of an aggregation against a local fake ERDDAP server and
+reports the results as JSON: metadata resolution, CSV parsing in
+timeseries.data(), timeseries.rows() and timeseries.batches(), reading the same batches
+from .nc responses, the sqlite ingest, sql_aggregate with the stdev
+aggregate against the numpy reduction of the same rows the sqlite engine
+uses, the stream engine, and writing the netcdf and .part files.
+"""
+from __future__ import print_function
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from erddap import erddap
+from aggrerddap import sqlite_connect, nextmonth, write_aggregation, valid_date
+from datetime import date
+import fake_erddap
+import argparse
+import json
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+class stage_timer():
+  def __init__(self):
+    self.results = {}
+
+  def run(self,name,fn,rows=None):
+    """
+    Runs fn, recording its wall and cpu seconds under name, and rows per
+    second when rows (a function of fn's result) is given.
+    """
+    # the library prints its urls, keep stdout for the json
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+      wall = time.time()
+      cpu = time.clock()
+      value = fn()
+      result = {"seconds": time.time() - wall, "cpu_seconds": time.clock() - cpu}
+    finally:
+      sys.stdout = stdout
+    if rows is not None:
+      result["rows"] = rows(value)
+      if result["seconds"] > 0:
+        result["rows_per_second"] = result["rows"] / result["seconds"]
+    self.results[name] = result
+    return value
+
+def sqlite_ingest(ts,table,rows):
+  conn = sqlite_connect(":memory:")
+  conn.execute(table.sql_create_table())
+  conn.executemany(table.sql_insert(),table.row_tuples(rows,[v["lcname"] for v in ts.variables()]))
+  return conn
+
+def sqlite_aggregate(table,conn,period):
+  keys = ",".join([o["name"] for o in table.columns if o["key"]])
+  conn.execute("create index idx_{0}_{1} on {0}({2},{1})".format(table.table_name,period,keys))
+  return pd.read_sql(table.sql_aggregate(period),conn)
+
+def sqlite_reduce(ts,table,conn,period):
+  stream = ts.stream(period)
+  for df in pd.read_sql(table.sql_rows(),conn,chunksize=100000):
+    stream.add_batch(df)
+  return stream.frame()
+
+def stream_aggregate(ts,frames,period):
+  stream = ts.stream(period)
+  for df in frames:
+    stream.add_batch(stream.prepare_batch(df))
+  return stream.frame()
+
+def benchmark(base_url,month,period,out_dir):
+  timer = stage_timer()
+  min_date = date(month.year,month.month,1)
+  max_date = nextmonth(min_date)
+  ts = timer.run("metadata",lambda: erddap(base_url).timeseries()[0])
+  timer.run("variables",ts.variables)
+  timer.run("data_csv",lambda: list(ts.data(min_date,max_date)),len)
+  rows = timer.run("rows_csv",lambda: list(ts.rows(min_date,max_date)),len)
+  frames = timer.run("batches_csv",lambda: list(ts.batches(min_date,max_date)),lambda f: sum([len(df) for df in f]))
+  ts.transport = "nc"
+  timer.run("batches_nc",lambda: list(ts.batches(min_date,max_date)),lambda f: sum([len(df) for df in f]))
+  ts.transport = "csv"
+  table = ts.sqlite()
+  conn = timer.run("sqlite_ingest",lambda: sqlite_ingest(ts,table,rows),lambda c: len(rows))
+  timer.run("sqlite_aggregate",lambda: sqlite_aggregate(table,conn,period),lambda df: len(rows))
+  timer.run("sqlite_reduce",lambda: sqlite_reduce(ts,table,conn,period),lambda df: len(rows))
+  conn.close()
+  df = timer.run("stream_aggregate",lambda: stream_aggregate(ts,frames,period),lambda df: len(rows))
+  timer.run("write",lambda: write_aggregation(ts,df,min_date,period,
+                                              os.path.join(out_dir,"data"),os.path.join(out_dir,"config")))
+  return timer.results
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--month", type=valid_date, default=valid_date("2017-11"), help="Month to aggregate, format YYYY-MM")
+  parser.add_argument("--period", default="hourly")
+  parser.add_argument("--columns", type=int, default=10)
+  parser.add_argument("--step", type=int, default=60, help="Seconds between rows")
+  parser.add_argument("--stations", type=int, default=1)
+  parser.add_argument("--nan_density", type=float, default=0.1)
+  parser.add_argument("--base_url", help="Benchmark against this server instead of the fake one")
+  parser.add_argument("--output", help="Also write the results to this file")
+  args = parser.parse_args()
+
+  server = None
+  base_url = args.base_url
+  if base_url is None:
+    server, base_url = fake_erddap.start(fake_erddap.dataset(args.columns,args.step,args.stations,args.nan_density))
+  out_dir = tempfile.mkdtemp()
+  try:
+    results = {
+      "parameters": {"month": args.month.strftime("%Y-%m"), "period": args.period, "columns": args.columns,
+                     "step": args.step, "stations": args.stations, "nan_density": args.nan_density},
+      "stages": benchmark(base_url,args.month,args.period,out_dir),
+    }
+  finally:
+    shutil.rmtree(out_dir)
+    if server is not None:
+      server.terminate()
+  print(json.dumps(results,indent=2,sort_keys=True))
+  if args.output:
+    with open(args.output,"w") as out:
+      json.dump(results,out,indent=2,sort_keys=True)
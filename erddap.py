@@ -1,12 +1,38 @@
 from __future__ import print_function
 import requests
+from requests.packages.urllib3.util.retry import Retry
 import inflection
 import time
+import calendar
 import os
 from datetime import date, datetime, timedelta
 from contextlib import closing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
 import csv
+import io
+import json
 import urllib
+import itertools
+import threading
+import tempfile
+import numpy as np
+import pandas as pd
+from httpcache import http_cache
+import metrics
+import reductions
+try:
+  import netCDF4
+except ImportError:
+  netCDF4 = None
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+TRANSPORTS = ["csv","nc"]
 
 def cassandra_type(t):
    known = {"String": "text"}
@@ -33,12 +59,43 @@ def remap_tabledap(tabledap):
        answer.append(o)
     return answer
 
-def tabledap(url):
-   r = requests.get(url) 
+def tabledap(url,session=requests,stage="metadata"):
+   """
+   The rows of a tabledap json query as dicts, [] when nothing matched,
+   the request timed under `stage` in the metrics.
+   """
+   start = time.time()
+   with metrics.stage(stage):
+     r = session.get(url) 
+   metrics.record("http",url=url,status=r.status_code,bytes=len(r.content),seconds=time.time()-start)
    if r.status_code == 200:
      return remap_tabledap(r.json())
-   else:
+   elif r.status_code == 404:
+     # erddap's answer when nothing matches
      return []
+   raise requests.exceptions.HTTPError("{0} answered {1}".format(url,r.status_code),response=r)
+
+class pooled_session(requests.Session):
+  """
+  A requests.Session keeping up to pool_size keep-alive connections per
+  host, asking for gzip, retrying connection errors, timeouts and 5xx
+  answers with exponential backoff (backoff, 2*backoff, 4*backoff...
+  seconds) and applying `timeout` to requests that don't give their own.
+  """
+  def __init__(self,pool_size=10,retries=3,backoff=1.0,timeout=None):
+    requests.Session.__init__(self)
+    retry = Retry(total=retries,connect=retries,read=retries,status=retries,backoff_factor=backoff,
+                  status_forcelist=[500,502,503,504],raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size,max_retries=retry)
+    self.mount("http://",adapter)
+    self.mount("https://",adapter)
+    self.headers["Accept-Encoding"] = "gzip, deflate"
+    self.timeout = timeout
+
+  def request(self,method,url,**kwargs):
+    if kwargs.get("timeout") is None:
+      kwargs["timeout"] = self.timeout
+    return requests.Session.request(self,method,url,**kwargs)
 
 def filtered(seq,match):
   for o in seq:
@@ -50,30 +107,234 @@ def filtered(seq,match):
           wanted = False
     if wanted: yield o
 
+def ordered_map(fn,seq,workers=1):
+  """
+  Yields fn(x) for each x in seq, in order. With more than one worker the
+  calls run on a thread pool, with at most `workers` results fetched ahead
+  of the consumer.
+  """
+  if workers <= 1:
+    for x in seq:
+      yield fn(x)
+    return
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = deque()
+    for x in seq:
+      pending.append(pool.submit(fn,x))
+      if len(pending) >= workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def join_csv(first,second):
+  """
+  Appends the rows of one tabledap csv response to another, dropping the
+  second's two header lines.
+  """
+  if first is None:
+    return second
+  if second is None:
+    return first
+  lines = second.split(b"\n",2)
+  return first.rstrip(b"\n") + b"\n" + (lines[2] if len(lines) > 2 else b"")
+
+def join_parts(first,second):
+  """
+  The join_csv of binary responses, which can't be appended to each
+  other: the parts of a split window are kept in a list.
+  """
+  parts = []
+  for part in [first,second]:
+    if isinstance(part,list):
+      parts.extend(part)
+    elif part is not None:
+      parts.append(part)
+  return parts or None
+
+def read_netcdf(content,variables):
+  """
+  Reads the arrays of a tabledap .nc response, or a list of them from a
+  split window, into a DataFrame laid out like the csv batches.
+  """
+  if isinstance(content,list):
+    return pd.concat([read_netcdf(part,variables) for part in content],ignore_index=True)
+  columns = {}
+  with closing(netCDF4.Dataset("window.nc",memory=content)) as nc:
+    for v in variables:
+      values = nc.variables[v["name"]][:]
+      if values.dtype.kind == "S":
+        columns[v["lcname"]] = netCDF4.chartostring(np.ma.filled(values,b"")).astype(object)
+        continue
+      if values.dtype.kind in "UO":
+        # char variables with an _Encoding, as erddap writes strings, come back decoded
+        columns[v["lcname"]] = np.ma.filled(values,u"").astype(object)
+        continue
+      if values.dtype.kind in "iu" and v["cassandra_type"] not in ["timestamp","float","double","int"]:
+        # short, byte, long... as text spelled as in the csv, 1 not 1.0 and NaN where missing
+        values = np.ma.asarray(values)
+        text = values.filled(0).astype(str).astype(object)
+        text[np.ma.getmaskarray(values)] = "NaN"
+        columns[v["lcname"]] = text
+        continue
+      values = np.ma.filled(np.ma.asarray(values).astype(np.float64),np.nan)
+      if v["cassandra_type"] == "timestamp":
+        values = np.datetime_as_string(values.astype(np.int64).astype("datetime64[s]"),unit="s",timezone="UTC")
+        columns[v["lcname"]] = values.astype(object)
+      elif v["cassandra_type"] in ["float","double","int"]:
+        columns[v["lcname"]] = values
+      else:
+        text = values.astype(str).astype(object)
+        text[np.isnan(values)] = "NaN"
+        columns[v["lcname"]] = text
+  return pd.DataFrame(columns,columns=[v["lcname"] for v in variables])
+
+class window_planner():
+  """
+  Splits [start, end), in epoch seconds, into download windows. Without
+  targets every window spans `days`, as get_dates does. With target_rows
+  and/or target_bytes each window is sized from the rows and bytes per
+  second of data observed in the windows before it. Windows are handed
+  out ahead of the downloads when several workers run, so their sizes lag
+  the observations by up to that many windows.
+  """
+  def __init__(self,start,end,days=60,target_rows=None,target_bytes=None,
+               min_span=3600,max_span=366*24*3600):
+    self.position = start
+    self.end = end
+    self.target_rows = target_rows
+    self.target_bytes = target_bytes
+    self.min_span = min_span
+    self.max_span = max_span
+    # nothing is known about the density yet, so an adaptive plan starts
+    # with a one day probe and grows from there
+    self.span = 24*3600 if self.adaptive() else days*24*3600
+    self.lock = threading.Lock()
+
+  def adaptive(self):
+    return bool(self.target_rows or self.target_bytes)
+
+  def __iter__(self):
+    while True:
+      with self.lock:
+        if self.position >= self.end:
+          return
+        start = self.position
+        self.position = min(start + int(self.span),self.end)
+        end = self.position
+      yield start, end
+
+  def observe(self,start,end,rows,nbytes):
+    if not self.adaptive():
+      return
+    seconds = end - start
+    if rows:
+      spans = []
+      if self.target_rows:
+        spans.append(self.target_rows * seconds / float(rows))
+      if self.target_bytes and nbytes:
+        spans.append(self.target_bytes * seconds / float(nbytes))
+      span = min(spans)
+    else:
+      # nothing there, look further ahead
+      span = self.span * 2
+    with self.lock:
+      # at most a factor of 4 per window, so one odd window can't swing it
+      span = max(self.span / 4.0,min(self.span * 4.0,span))
+      self.span = max(self.min_span,min(self.max_span,span))
+
+  def shrink(self):
+    with self.lock:
+      self.span = max(self.min_span,self.span / 2.0)
+
+  def can_split(self,start,end):
+    return self.adaptive() and end - start >= 2 * self.min_span
+
+def counted_lines(lines,info):
+  for line in lines:
+    info["bytes"] += len(line) + 1
+    yield line
+
 def parse_iso_timestamp(timestamp):
     return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ" )
 
+# H. Hinnant's calendar algorithms, written with floor division and no
+# branches so they work on ints and numpy arrays alike
+
+def days_from_civil(y,m,d):
+    # days since 1970-01-01 of a proleptic Gregorian date
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153*(m + 9 - 12*(m > 2)) + 2)//5 + d-1
+    doe = yoe * 365 + yoe//4 - yoe//100 + doy
+    return era * 146097 + doe - 719468
+
+def civil_from_days(days):
+    # the year, month and day of a count of days since 1970-01-01
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe//1460 + doe//36524 - doe//146096) // 365
+    doy = doe - (365*yoe + yoe//4 - yoe//100)
+    mp = (5*doy + 2)//153
+    m = mp + 3 - 12*(mp >= 10)
+    return yoe + era*400 + (m <= 2), m, doy - (153*mp + 2)//5 + 1
+
+def epoch_seconds(timestamp):
+    """
+    The epoch seconds of an ISO timestamp, without strptime.
+    """
+    days = days_from_civil(int(timestamp[0:4]),int(timestamp[5:7]),int(timestamp[8:10]))
+    return days*86400 + int(timestamp[11:13])*3600 + int(timestamp[14:16])*60 + int(timestamp[17:19])
+
+def period_keys(seconds):
+    """
+    The minutely, hourly, daily, weekly and monthly bucket numbers of a time
+    in epoch seconds, or of a numpy array of them. They split time as the
+    PERIOD_FORMATS do, weeks starting on monday as %W, and sort in time
+    order.
+    """
+    days = seconds // 86400
+    year, month, day = civil_from_days(days)
+    yday = days - days_from_civil(year,1,1)
+    # monday is 0, 1970-01-01 was a thursday
+    weekday = (days + 3) % 7
+    week = (yday + 7 - weekday) // 7
+    return (seconds // 60, seconds // 3600, days, year*100 + week, year*12 + month - 1)
+
+def format_epoch(seconds):
+    return datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%SZ")
+
 class timeseries():
   _metadata = None
+  _attributes = None
+  _variable_rows = None
   _variables = None
   _min_time = None
   id = None
-  def __init__(self,info,namespace="ts"):
+  def __init__(self,info,namespace="ts",session=requests,workers=1,cache_dir=None,
+               target_rows=None,target_bytes=None,timeout=None,transport="csv"):
     self.info = info
     self.id = info["datasetID"]
     self.namespace = namespace
+    self.session = session
+    self.workers = workers
+    self.cache_dir = cache_dir
+    self.target_rows = target_rows
+    self.target_bytes = target_bytes
+    self.timeout = timeout
+    self.transport = transport
 
   def metadata(self):
      if not self._metadata:
         url = "{0}.json".format(self.info["metadata"])
-        self._metadata = tabledap(url)
+        self._metadata = tabledap(url,self.session)
      return self._metadata
 
   def tabledap_url(self):
         return "{0}.json".format(self.info["tabledap"])
 
-  def data(self,min_date=None,max_date=None,constraints=[]):
-    timecol = self.time_column()
+  def windows(self,min_date=None,max_date=None):
     if min_date is None:
       mt = parse_iso_timestamp(self.min_time())
       min_date = date(mt.year,mt.month,mt.day)
@@ -81,44 +342,177 @@ class timeseries():
          min_date = date(2000,01,01)
     if max_date is None:
       max_date = date.today() + timedelta(days=365)
-    
-    dates = get_dates(min_date,max_date,days=60)
+    return window_planner(calendar.timegm(min_date.timetuple()),calendar.timegm(max_date.timetuple()),
+                          days=60,target_rows=self.target_rows,target_bytes=self.target_bytes)
+
+  def window_url(self,constraints=[],fmt="csv"):
+    timecol = self.time_column()
     variables = self.variables()
     sconstraints = ""
     print(constraints)
     if constraints and len(constraints):
       sconstraints = "&{0}".format("&".join([urllib.quote_plus(c) for c in constraints]))
-    base_url = "{0}.csv?{1}&{2}>={3}&{2}<{4}{5}".format(self.info["tabledap"],",".join([v["name"] for v in variables]),timecol,"{0}","{1}",sconstraints)
-    for d in range(len(dates)-1):
-      start = dates[d]
-      end = dates[d+1]
-      url = base_url.format(start,end)
+    return "{0}.{6}?{1}&{2}>={3}&{2}<{4}{5}".format(self.info["tabledap"],",".join([v["name"] for v in variables]),timecol,"{0}","{1}",sconstraints,fmt)
+
+  def get_window(self,base_url,planner,window,join=join_csv):
+    """
+    Downloads one window, returning its content (None when the server
+    answers 404, nothing matched) and a dict describing the request for
+    the metrics. When the planner is adaptive, a window that times out or
+    gets a server error is split in two and each half fetched on its own.
+    Otherwise a window that fails raises, rather than leaving a hole in
+    the month.
+    """
+    start, end = window
+    url = base_url.format(format_epoch(start),format_epoch(end))
+    print(url)
+    began = time.time()
+    status, content, error = None, b"", None
+    try:
+      with metrics.stage("download"):
+        r = self.session.get(url,timeout=self.timeout)
+        status, content = r.status_code, r.content
+    except requests.exceptions.RequestException as e:
+      error = e
+    metrics.count("bytes",len(content))
+    info = {"url": url, "status": status, "bytes": len(content), "seconds": time.time()-began,
+            "start": start, "end": end}
+    if (error is not None or status >= 500) and planner.can_split(start,end):
+      planner.shrink()
+      middle = start + (end - start) // 2
+      first, first_info = self.get_window(base_url,planner,(start,middle),join)
+      second, second_info = self.get_window(base_url,planner,(middle,end),join)
+      info.update({"status": "split", "bytes": first_info["bytes"] + second_info["bytes"],
+                   "seconds": time.time()-began})
+      return join(first,second), info
+    if error is None and status == 200:
+      return content, info
+    if error is None and status == 404:
+      return None, info
+    metrics.record("window",**info)
+    if error is not None:
+      raise error
+    raise requests.exceptions.HTTPError("{0} answered {1}".format(url,status),response=r)
+
+  def get_batch_window(self,csv_url,nc_url,planner,window):
+    """
+    get_window in the transport of batches(). A window the server fails
+    to give as .nc is fetched as csv. When it refuses the .nc query (a 4xx
+    answer) every later window of the series is fetched as csv too.
+    """
+    if self.transport == "nc":
+      try:
+        content, info = self.get_window(nc_url,planner,window,join_parts)
+        info["format"] = "nc"
+        return content, info
+      except requests.exceptions.HTTPError as e:
+        if e.response is not None and 400 <= e.response.status_code < 500:
+          print("no .nc output for {0} ({1}), using csv".format(self.id,e))
+          self.transport = "csv"
+        else:
+          print("no .nc window for {0} ({1}), fetching it as csv".format(self.id,e))
+      except requests.exceptions.RequestException as e:
+        print("no .nc window for {0} ({1}), fetching it as csv".format(self.id,e))
+    content, info = self.get_window(csv_url,planner,window)
+    info["format"] = "csv"
+    return content, info
+
+  def window_lines(self,min_date=None,max_date=None,constraints=[]):
+    planner = self.windows(min_date,max_date)
+    base_url = self.window_url(constraints)
+    if self.workers > 1 or planner.adaptive():
+      for content, info in ordered_map(partial(self.get_window,base_url,planner),planner,self.workers):
+        yield (content.splitlines() if content is not None else []), info
+        planner.observe(info["start"],info["end"],info.get("rows"),info["bytes"])
+      return
+    for start, end in planner:
+      url = base_url.format(format_epoch(start),format_epoch(end))
       print(url)
-      with closing(requests.get(url, stream=True)) as r:
+      with closing(self.session.get(url, stream=True, timeout=self.timeout)) as r:
+        info = {"url": url, "status": r.status_code, "bytes": 0, "start": start, "end": end}
         if r.status_code == 200:
-          # reader = csv.reader(r.iter_lines(), delimiter=',', quotechar='"')
-          reader = csv.reader(r.iter_lines())
-          i = 0
-          for row in reader:
-            i = i + 1
-            if i<=2:
-              continue
-            o = {}
-            for n in range(len(row)):
-               v = row[n]
-               variable = variables[n]
-               if variable["cassandra_type"] in ["float","double","int"]:
-                  if v == "NaN":
-                    o[variable["lcname"]] = None
-                  elif variable["cassandra_type"] in ["float","double"]:
-                    o[variable["lcname"]] = float(v)
-                  else:
-                    o[variable["lcname"]] = int(v)
-                    
-               else:
-                 o[variable["lcname"]] = v
-              
-            yield o
+          yield counted_lines(r.iter_lines(),info), info
+        elif r.status_code != 404:
+          metrics.record("window",**info)
+          raise requests.exceptions.HTTPError("{0} answered {1}".format(url,r.status_code),response=r)
+        else:
+          yield [], info
+
+  def data(self,min_date=None,max_date=None,constraints=[]):
+    names = [v["lcname"] for v in self.variables()]
+    for row in self.rows(min_date,max_date,constraints):
+      yield dict(zip(names,row))
+
+  def rows(self,min_date=None,max_date=None,constraints=[]):
+    """
+    Like data(), but yields each row as a tuple of its values in the order
+    of variables(), with no dict per row. Numbers are float or int, None
+    for NaN, everything else is str.
+    """
+    # 0 kept as text, 1 float, 2 int
+    kinds = []
+    for v in self.variables():
+      if v["cassandra_type"] in ["float","double"]:
+        kinds.append(1)
+      elif v["cassandra_type"] == "int":
+        kinds.append(2)
+      else:
+        kinds.append(0)
+    for lines, info in self.window_lines(min_date,max_date,constraints):
+      reader = csv.reader(lines)
+      i = 0
+      for row in reader:
+        i = i + 1
+        if i<=2:
+          continue
+        yield tuple([v if k == 0 else None if v == "NaN" else float(v) if k == 1 else int(v)
+                     for k, v in zip(kinds,row)])
+      info["rows"] = max(i-2,0)
+      metrics.count("rows",info["rows"])
+      metrics.record("window",**info)
+
+  def batches(self,min_date=None,max_date=None,constraints=[]):
+    """
+    Like data(), but yields one pandas DataFrame per download window with
+    the columns named by lcname and typed from variables(). Numeric columns
+    are float64 with NaN for missing values, everything else is str. With
+    the nc transport the windows are read as arrays from .nc responses
+    instead of parsed from csv.
+    """
+    planner = self.windows(min_date,max_date)
+    fetch = partial(self.get_batch_window,self.window_url(constraints),self.window_url(constraints,"nc"),planner)
+    for content, info in ordered_map(fetch,planner,self.workers):
+      df = self.read_window(planner,content,info)
+      if df is not None:
+        yield df
+
+  def read_window(self,planner,content,info):
+    """
+    The DataFrame of a window from get_batch_window, or None when it has
+    no rows, recording the window in the metrics and the planner.
+    """
+    variables = self.variables()
+    df = None
+    if content is not None and info["format"] == "nc":
+      with metrics.stage("read_nc"):
+        df = read_netcdf(content,variables)
+    elif content is not None:
+      dtypes = {}
+      na_values = {}
+      for v in variables:
+        if v["cassandra_type"] in ["float","double","int"]:
+          dtypes[v["lcname"]] = np.float64
+          na_values[v["lcname"]] = ["NaN"]
+        else:
+          dtypes[v["lcname"]] = object
+      with metrics.stage("parse_csv"):
+        df = pd.read_csv(io.BytesIO(content),header=None,skiprows=2,names=[v["lcname"] for v in variables],
+                         dtype=dtypes,na_values=na_values,keep_default_na=False)
+    info["rows"] = 0 if df is None else len(df)
+    metrics.count("rows",info["rows"])
+    metrics.record("window",**info)
+    planner.observe(info["start"],info["end"],info["rows"],info["bytes"])
+    return df if info["rows"] else None
 
   def time_column(self):
     for v in self.variables():
@@ -132,34 +526,153 @@ class timeseries():
        return summary["time_coverage_start"]
 
     if self._min_time is None:
-      timecol = self.time_column()
-      dates = get_dates(date(1990,1,1),date.today() + timedelta(days=1))
-      self._min_time = dates[0]
-      first = 0
-      last = len(dates)-2
-      base_url = "{0}?{1}&{1}>={2}&{1}<={3}&orderByMin(%22{1}%22)".format(
-          self.tabledap_url(),timecol,"{0}","{1}"
-        )
-    
-      while first<=last:
-        midpoint = (first + last)//2
-        url = base_url.format(dates[midpoint],dates[midpoint+1])
-        data = tabledap(url)
-        if len(data):
-          self._min_time = data[0][timecol]
-          last = midpoint-1
-        else:
-          first = midpoint+1
-      
+      self._min_time = self._load_min_time()
+    if self._min_time is None:
+      self._min_time = self._find_min_time()
+      self._save_min_time()
     return self._min_time
 
+  def _min_time_path(self):
+    if self.cache_dir is None:
+      return None
+    return os.path.join(self.cache_dir,"min_time.json")
+
+  def _load_min_time(self):
+    path = self._min_time_path()
+    if path is None or not os.path.exists(path):
+      return None
+    with open(path) as f:
+      return json.load(f).get(self.id)
+
+  def _save_min_time(self):
+    path = self._min_time_path()
+    if path is None:
+      return
+    known = {}
+    if os.path.exists(path):
+      with open(path) as f:
+        known = json.load(f)
+    known[self.id] = self._min_time
+    tmp = "{0}.{1}.tmp".format(path,os.getpid())
+    with open(tmp,"w") as out:
+      json.dump(known,out)
+    os.rename(tmp,path)
+
+  def _find_min_time(self):
+    """
+    The time of the first row: from the actual_range of the time variable
+    if the metadata has it, else from one orderByMin query over the whole
+    range. If the server fails that, the first decade, year or month, in
+    that order of fallback, whose orderByMin query returns a row holds the
+    minimum. A month the server fails too can't be ruled out, so that
+    raises rather than give a later time.
+    """
+    timecol = self.time_column()
+    actual_range = self.attributes().get(timecol,{}).get("actual_range")
+    if actual_range:
+      try:
+        return format_epoch(float(actual_range.split(",")[0]))
+      except ValueError:
+        pass
+
+    earliest = 1990
+    latest = date.today().year + 1
+    base_url = "{0}?{1}&{1}>={2}T00:00:00Z&{1}<{3}T00:00:00Z&orderByMin(%22{1}%22)".format(
+        self.tabledap_url(),timecol,"{0}","{1}"
+      )
+    probe = lambda start, end: self._first_time(base_url.format(start.isoformat(),end.isoformat()),timecol)
+    ok, first = probe(date(earliest,1,1),date(latest,1,1))
+    if ok:
+      return first or "{0}-01-01T00:00:00Z".format(earliest)
+    for decade in range(earliest,latest,10):
+      ok, first = probe(date(decade,1,1),date(min(decade+10,latest),1,1))
+      if ok and first:
+        return first
+      if ok:
+        continue
+      for year in range(decade,min(decade+10,latest)):
+        ok, first = probe(date(year,1,1),date(year+1,1,1))
+        if ok and first:
+          return first
+        if ok:
+          continue
+        for month in range(1,13):
+          ok, first = probe(date(year,month,1),date(year+month//12,month%12+1,1))
+          if not ok:
+            raise requests.exceptions.HTTPError("the orderByMin query of {0} for {1}-{2:02d} failed".format(self.id,year,month))
+          if first:
+            return first
+    return "{0}-01-01T00:00:00Z".format(earliest)
+
+  def _first_time(self,url,timecol):
+    """
+    Runs an orderByMin query, returning whether the server answered and
+    the time it found, None when nothing matched.
+    """
+    try:
+      r = self.session.get(url)
+      if r.status_code == 200:
+        data = remap_tabledap(r.json())
+        return True, data[0][timecol] if len(data) else None
+    except (requests.exceptions.RequestException,ValueError):
+      return False, None
+    # erddap answers 404 when nothing matches
+    return r.status_code == 404, None
+
+  def fingerprint(self,min_date,max_date,constraints=[]):
+    """
+    A summary of the rows of a window worked out by the server, so a
+    change in the source can be told without downloading them: the number
+    of values of each variable (orderByCount) and the first and last time
+    (orderByMinMax). None when the server can't answer these queries.
+    """
+    timecol = self.time_column()
+    base_url = self.window_url(constraints,"json").format("{0}T00:00:00Z".format(min_date.isoformat()),
+                                                          "{0}T00:00:00Z".format(max_date.isoformat()))
+    # only the time for the min/max query, the constraints may name other variables
+    minmax_url = "{0}.json?{1}&{2}".format(self.info["tabledap"],timecol,base_url.split("&",1)[1])
+    try:
+      counts = tabledap("{0}&orderByCount(%22%22)".format(base_url),self.session,"fingerprint")
+      if not len(counts):
+        return {"rows": 0, "counts": {}, "min_time": None, "max_time": None}
+      times = [o[timecol] for o in tabledap("{0}&orderByMinMax(%22{1}%22)".format(minmax_url,timecol),self.session,"fingerprint")]
+    except (requests.exceptions.RequestException,ValueError,KeyError):
+      return None
+    return {"rows": counts[0][timecol], "counts": counts[0],
+            "min_time": min(times) if times else None, "max_time": max(times) if times else None}
+
+  def expire_cached(self,min_date,max_date):
+    """
+    Expires the cached windows between the dates, which a closed month
+    keeps for long, once its fingerprint shows the source changed.
+    """
+    if isinstance(self.session,http_cache):
+      self.session.expire(self.info["tabledap"],datetime.combine(min_date,datetime.min.time()),
+                          datetime.combine(max_date,datetime.min.time()))
+
+  def _index_metadata(self):
+    # one pass over the metadata rows, so later lookups need no scans
+    attributes = {}
+    variable_rows = []
+    for row in self.metadata():
+      if row["Row Type"] == "variable":
+        variable_rows.append(row)
+      elif row["Row Type"] == "attribute":
+        attributes.setdefault(row["Variable Name"],{})[row["Attribute Name"]] = row["Value"]
+    self._attributes = attributes
+    self._variable_rows = variable_rows
+
+  def attributes(self):
+    """
+    The metadata attributes as {variable name: {attribute name: value}},
+    with the global attributes under NC_GLOBAL.
+    """
+    if self._attributes is None:
+      self._index_metadata()
+    return self._attributes
+
   def summary(self):
-    metadata = self.metadata()
-    info = {}
-    items = filtered(metadata,{"Variable Name": "NC_GLOBAL"})
-    for item in items:
-      info[item["Attribute Name"]] = item["Value"]
-    return info
+    return dict(self.attributes().get("NC_GLOBAL",{}))
 
   def variables(self):
      if not self._variables:
@@ -173,19 +686,7 @@ class timeseries():
             "Y": {"name": "latitude", "type": "double"},
         }
             #"Z": {"name": "altitude", "type": "double"}
-        identifiers = [x["Variable Name"] for x in
-                       filtered(self.metadata(), {
-                           "Row Type": "attribute",
-                           "Attribute Name": "ioos_category",
-                           "Value": "Identifier"
-                        })]
-        quality = [x["Variable Name"] for x in
-                       filtered(self.metadata(), {
-                           "Row Type": "attribute",
-                           "Attribute Name": "ioos_category",
-                           "Value": "Quality"
-                        })]
-        v = filtered(self.metadata(),{"Row Type": "variable"})
+        attributes = self.attributes()
         answer = [ { 
                     "name": x["Variable Name"], 
                     "lcname": inflection.underscore(x["Variable Name"]), 
@@ -195,30 +696,21 @@ class timeseries():
                     "quality": False,
                     "axis": False,
                     "units": None
-                   } for x in v]
+                   } for x in self._variable_rows]
         for x in answer:
-           if x["name"] in identifiers:
+           attrs = attributes.get(x["name"],{})
+           if attrs.get("ioos_category") == "Identifier":
               x["identifier"] = True
-           if x["name"] in quality:
+           if attrs.get("ioos_category") == "Quality":
               x["quality"] = True
 
-           axis = [a for a in filtered(self.metadata(), {
-                           "Row Type": "attribute",
-                           "Attribute Name": "axis",
-                           "Variable Name": x["name"]
-                        })]
-           if len(axis):
+           if "axis" in attrs:
               x["axis"] = True
-              if axis[0]["Value"] in tr_axis:
-                 x["lcname"] = tr_axis[axis[0]["Value"]]["name"]
-                 x["cassandra_type"] = tr_axis[axis[0]["Value"]]["type"]
-           units = [a["Value"] for a in filtered(self.metadata(), {
-                           "Row Type": "attribute",
-                           "Attribute Name": "units",
-                           "Variable Name": x["name"]
-                        })]
-           if len(units):
-             x["units"] = units[0]
+              if attrs["axis"] in tr_axis:
+                 x["lcname"] = tr_axis[attrs["axis"]]["name"]
+                 x["cassandra_type"] = tr_axis[attrs["axis"]]["type"]
+           if "units" in attrs:
+             x["units"] = attrs["units"]
 
         self._variables = sorted(answer, key=lambda o: (-o["identifier"],o["lcname"]))
      return self._variables
@@ -235,6 +727,22 @@ class timeseries():
   def sqlite(self):
      return sqlite3_table(self.base_table_name(),self.summary(),variables=self.variables())
 
+  def stream(self,period):
+     return stream_table(self.base_table_name(),self.summary(),period,variables=self.variables())
+
+PERIODS = ["minutely","hourly","daily","weekly","monthly"]
+# the buckets of period_keys as strftime formats
+PERIOD_FORMATS = {
+    "minutely": "%Y-%m-%dT%H%M",
+    "hourly": "%Y-%m-%dT%H",
+    "daily": "%Y-%m-%d",
+    "weekly": "%Y-%W",
+    "monthly": "%Y-%m",
+}
+# saved stream states with another version are recomputed, version 2 keeps times as epoch seconds,
+# version 3 the buckets as arrays
+STATE_VERSION = 3
+
 class sqlite3_table():
   def __init__(self,table_name,summary,variables=None, columns=None):
     self.table_name = table_name
@@ -244,17 +752,48 @@ class sqlite3_table():
       self.columns = self._erddap2columns(variables)
 
   def tuplify(self,o):
-     mt = parse_iso_timestamp(o["time"])
-     o["minutely"] = mt.strftime("%Y-%m-%dT%H%M" )
-     o["hourly"] = mt.strftime("%Y-%m-%dT%H" )
-     o["daily"] = mt.strftime("%Y-%m-%d")
-     o["weekly"] =  mt.strftime("%Y-%W")
-     o["monthly"] =  mt.strftime("%Y-%m")
+     seconds = epoch_seconds(o["time"])
+     for period, key in zip(PERIODS,period_keys(seconds)):
+       o[period] = key
      answer = []
      for v in self.columns:
-       answer.append(o[v["name"]])
+       answer.append(seconds if v["name"] == "time" else o[v["name"]])
      return tuple(answer)
 
+  def tuples(self,rows):
+     """
+     Yields the insert tuple of each row from timeseries.data(), to be
+     passed straight to executemany. The time goes in as epoch seconds.
+     """
+     names = [o["name"] for o in self.columns]
+     # 0 to 4 the period keys, 5 the time, None a value of the row
+     positions = [PERIODS.index(n) if n in PERIODS else 5 if n == "time" else None for n in names]
+     for o in rows:
+       seconds = epoch_seconds(o["time"])
+       keys = period_keys(seconds) + (seconds,)
+       yield tuple([o[n] if p is None else keys[p] for n, p in zip(names,positions)])
+
+  def row_tuples(self,rows,names):
+     """
+     Yields the insert tuple of each row tuple from timeseries.rows(), whose
+     values are in the order of `names`. The epoch seconds of the time and
+     the period keys are appended to the row and one itemgetter picks every
+     column in insert order.
+     """
+     time_index = names.index("time")
+     positions = []
+     for o in self.columns:
+       if o["name"] in PERIODS:
+         positions.append(len(names)+1+PERIODS.index(o["name"]))
+       elif o["name"] == "time":
+         positions.append(len(names))
+       else:
+         positions.append(names.index(o["name"]))
+     getter = itemgetter(*positions)
+     for row in rows:
+       seconds = epoch_seconds(row[time_index])
+       yield getter(row + (seconds,) + period_keys(seconds))
+
   def _erddap2columns(self,variables):
      pks = []
      varnames = []
@@ -268,8 +807,8 @@ class sqlite3_table():
        else: 
           varnames.append(v["lcname"])
 
-     for v in ["minutely","hourly","daily","weekly","monthly"]:
-       cols.append({"name": v, "type": "text", "key": False, "erddap_name": None})
+     for v in PERIODS:
+       cols.append({"name": v, "type": "integer", "key": False, "erddap_name": None})
 
      for s in ["latitude","longitude","time"]:
        if s in varnames:
@@ -297,7 +836,7 @@ class sqlite3_table():
      return """
     (select {0}, {1}, min({2}) minimum_{2}, time minimum_{2}_time from {3} group by {0},{1}) {2}_minimum, 
     (select {0}, {1}, max({2}) maximum_{2}, time maximum_{2}_time from {3} group by {0},{1}) {2}_maximum, 
-    (select {0}, {1}, strftime('%Y-%m-%dT%H:%M:%SZ',datetime(avg(strftime('%s',time)),'unixepoch')) mean_time, {4} stdev({2}) stdev_{2}, avg({2}) mean_{2} from {3} group by {0},{1}) {2}_mean""".format(', '.join(keys),period,col,self.table_name,axis_part)
+    (select {0}, {1}, sum(time)/count(time) mean_time, {4} stdev({2}) stdev_{2}, avg({2}) mean_{2} from {3} group by {0},{1}) {2}_mean""".format(', '.join(keys),period,col,self.table_name,axis_part)
 
   def get_join_part(self,keys,period,first_col,other_col):
       conditions = []
@@ -312,15 +851,32 @@ class sqlite3_table():
   def get_select_part(self,col,period):
       return "mean_{1}, stdev_{1}, minimum_{1}, minimum_{1}_time, maximum_{1}, maximum_{1}_time".format(period,col)
 
-  def sql_aggregate(self,period):
+  def aggregate_columns(self):
      keys = [o["name"] for o in filtered(self.columns,{"key": True})]
      skip = [k for k in keys]
      skip.extend([o["name"] for o in filtered(self.columns,{"quality": True})])
-     skip.extend(["minutely","hourly","daily","weekly","monthly","time"])
+     skip.extend(PERIODS+["time"])
      axis = [o["name"] for o in filtered(self.columns,{"axis": True}) if o["name"] not in skip ]
      skip.extend(axis)
 
      columns = [o["name"] for o in self.columns if o["name"].lower() not in skip and o["type"] in ["float","double","int"]]
+     return keys, axis, columns
+
+  def sql_rows(self,period=None):
+     """
+     Selects every row with its period keys, the time as _epoch, the axis
+     and the measures, the batches stream_table.add_batch reduces. With a
+     period, in the order of its buckets.
+     """
+     keys, axis, columns = self.aggregate_columns()
+     cols = keys + PERIODS + ["time _epoch"] + axis + columns
+     order = ""
+     if period is not None:
+       order = " order by {0}".format(", ".join([period]+keys))
+     return "select {0} from {1}{2};".format(", ".join(cols),self.table_name,order)
+
+  def sql_aggregate(self,period):
+     keys, axis, columns = self.aggregate_columns()
      first_col = columns[0]
      cols = ["{0}_mean.{1}".format(first_col,k) for k in keys+axis]
      cols.append("{0}_mean.mean_time time".format(first_col,period))
@@ -338,6 +894,268 @@ class sqlite3_table():
         
      return "select {0} from {1} where {2};".format(",\n    ".join(cols),",\n    ".join(tables),"\n     AND ".join(conditions))
 
+class stream_table(sqlite3_table):
+  """
+  Computes the same aggregations as sqlite3_table.sql_aggregate from the
+  DataFrames of timeseries.batches(), without loading the rows into a
+  database. The running state of the (keys, period) buckets is kept in
+  numpy arrays with a row per bucket: the time sum and count, the sum and
+  count of each axis and the count, mean, M2, minimum and maximum of each
+  measure, with the times of the minimum and maximum.
+  """
+  def __init__(self,table_name,summary,period,variables=None, columns=None):
+    sqlite3_table.__init__(self,table_name,summary,variables=variables,columns=columns)
+    self.period = period
+    self.keys, self.axis, self.measures = self.aggregate_columns()
+    self._int_measures = [o["type"] == "int" for o in self.columns if o["name"] in self.measures]
+    self.state = None
+    self.count = 0
+    self.last_time = None
+    self.since = None
+    self._spill = None
+
+  def __len__(self):
+     return 0 if self.state is None else len(self.state["time_n"])
+
+  def prepare_batch(self,df):
+     """
+     Adds the period bucket columns and the epoch seconds of each row to a
+     DataFrame from timeseries.batches(), the batch form of tuplify. The
+     timestamps are parsed once and the buckets derived from the seconds.
+     """
+     seconds = pd.to_datetime(df["time"],format="%Y-%m-%dT%H:%M:%SZ").values.astype("datetime64[s]").astype(np.int64)
+     columns = dict(zip(PERIODS,period_keys(seconds)))
+     columns["_epoch"] = seconds
+     return df.assign(**columns)
+
+  def add_batch(self,df):
+     """
+     Reduces a batch from prepare_batch per bucket and merges the result
+     into the running states, so buckets may span several batches.
+     """
+     if self.since is not None:
+        df = df[df["_epoch"] > self.since]
+     if not len(df):
+        return
+     latest = int(df["_epoch"].values.max())
+     if self.last_time is None or latest > self.last_time:
+        self.last_time = latest
+     self._merge(self._reduce(df))
+     self.count += len(df)
+
+  def _reduce(self,df):
+     by = self.keys+[self.period]
+     epoch = df["_epoch"].values
+     buckets = reductions.groups(*[df[k].values for k in by])
+     size = len(buckets)
+     axis = [buckets.reduce(df[a].values) for a in self.axis]
+     measures = [buckets.reduce(df[m].values) for m in self.measures]
+     times = lambda rows: np.where(rows >= 0,epoch[rows],0)
+     return {
+        "group": [df[k].values[buckets.first] for k in by],
+        "time_sum": buckets.sum(epoch),
+        "time_n": buckets.counts,
+        "axis_sum": stacked([r["sum"] for r in axis],size,np.float64),
+        "axis_n": stacked([r["count"] for r in axis],size,np.int64),
+        "n": stacked([r["count"] for r in measures],size,np.int64),
+        "mean": stacked([r["mean"] for r in measures],size,np.float64),
+        "m2": stacked([r["m2"] for r in measures],size,np.float64),
+        "minimum": stacked([r["minimum"] for r in measures],size,np.float64),
+        "minimum_time": stacked([times(r["argmin"]) for r in measures],size,np.int64),
+        "maximum": stacked([r["maximum"] for r in measures],size,np.float64),
+        "maximum_time": stacked([times(r["argmax"]) for r in measures],size,np.int64),
+     }
+
+  def _merge(self,state):
+     """
+     Adds the bucket states of a batch to the running ones. The states of
+     a bucket found in both are combined pairwise, the running state
+     keeping ties of the minimum and maximum as it came first.
+     """
+     if self.state is None:
+        self.state = state
+        return
+     both = dict((k,np.concatenate([self.state[k],state[k]])) for k in state if k != "group")
+     both["group"] = [np.concatenate([a,b]) for a, b in zip(self.state["group"],state["group"])]
+     buckets = reductions.groups(*both["group"])
+     if len(buckets) == len(both["time_n"]):
+        # no bucket in both
+        self.state = both
+        return
+     n = both["n"]
+     total = buckets.sum(n)
+     with np.errstate(invalid="ignore",divide="ignore"):
+        mean = buckets.sum(np.where(n > 0,n*both["mean"],0.0)) / total
+        delta = np.where(n > 0,both["mean"] - buckets.broadcast(mean),0.0)
+     merged = {
+        "group": [g[buckets.first] for g in both["group"]],
+        "time_sum": buckets.sum(both["time_sum"]),
+        "time_n": buckets.sum(both["time_n"]),
+        "axis_sum": buckets.sum(both["axis_sum"]),
+        "axis_n": buckets.sum(both["axis_n"]),
+        "n": total,
+        "mean": mean,
+        "m2": buckets.sum(both["m2"] + n*delta*delta),
+     }
+     for name in ["minimum","maximum"]:
+        extremes = [buckets.reduce(both[name][:,m]) for m in range(len(self.measures))]
+        rows = [r["argmin" if name == "minimum" else "argmax"] for r in extremes]
+        merged[name] = stacked([r[name] for r in extremes],len(buckets),np.float64)
+        merged[name+"_time"] = stacked([np.where(r >= 0,both[name+"_time"][r,m],0) for m, r in enumerate(rows)],
+                                       len(buckets),np.int64)
+     self.state = merged
+
+  def _take(self,rows):
+     state = dict((k,v[rows]) for k, v in self.state.items() if k != "group")
+     state["group"] = [g[rows] for g in self.state["group"]]
+     return state
+
+  def finished(self):
+     """
+     Removes the buckets of the periods before that of last_time and
+     returns them as frame() does. When the batches come in time order,
+     as the download windows do, those buckets get no more rows.
+     """
+     if not len(self):
+        return None
+     current = period_keys(self.last_time)[PERIODS.index(self.period)]
+     done = self.state["group"][-1] < current
+     if not done.any():
+        return None
+     answer = self._frame(self._take(done))
+     self.state = self._take(~done)
+     return answer
+
+  def spill_finished(self,chunk_rows):
+     """
+     Moves the finished() buckets to a temporary file, in pieces of
+     chunk_rows rows, so only the buckets of the current period are held.
+     chunks() reads them back.
+     """
+     df = self.finished()
+     if df is None:
+        return
+     if self._spill is None:
+        self._spill = tempfile.TemporaryFile()
+     self._spill.seek(0,os.SEEK_END)
+     for start in range(0,len(df),chunk_rows):
+        pickle.dump(df.iloc[start:start+chunk_rows],self._spill,pickle.HIGHEST_PROTOCOL)
+
+  def _spilled(self):
+     if self._spill is None:
+        return
+     self._spill.seek(0)
+     while True:
+        try:
+           yield pickle.load(self._spill)
+        except EOFError:
+           return
+
+  def save_state(self,path):
+     """
+     Saves the running bucket states and the last processed time, so a
+     later run can carry on from them with load_state.
+     """
+     buckets = None
+     if len(self):
+        buckets = dict((k,v.tolist()) for k, v in self.state.items() if k != "group")
+        buckets["group"] = [g.tolist() for g in self.state["group"]]
+     state = {
+        "version": STATE_VERSION,
+        "columns": [self.keys,self.axis,self.measures,self.period],
+        "last_time": self.last_time,
+        "buckets": buckets,
+     }
+     with open(path+".tmp","w") as out:
+        json.dump(state,out)
+     os.rename(path+".tmp",path)
+
+  def load_state(self,path):
+     with open(path) as f:
+        state = json.load(f)
+     if state.get("version") != STATE_VERSION or state["columns"] != [self.keys,self.axis,self.measures,self.period]:
+        return False
+     self.state = None
+     if state["buckets"] is not None:
+        buckets = state["buckets"]
+        size = len(buckets["time_n"])
+        self.state = {"group": [np.array(g,dtype=object) for g in buckets["group"][:-1]] +
+                               [np.array(buckets["group"][-1],dtype=np.int64)]}
+        for k, v in buckets.items():
+           if k != "group":
+              dtype = np.float64 if k in ["axis_sum","mean","m2","minimum","maximum"] else np.int64
+              self.state[k] = np.array(v,dtype=dtype).reshape((size,)+np.shape(v)[1:])
+     self.last_time = self.since = state["last_time"]
+     return True
+
+  def output_columns(self):
+     cols = self.keys + self.axis + ["time"]
+     for col in self.measures:
+        cols.extend(["mean_{0}".format(col), "stdev_{0}".format(col),
+                     "minimum_{0}".format(col), "minimum_{0}_time".format(col),
+                     "maximum_{0}".format(col), "maximum_{0}_time".format(col)])
+     return cols
+
+  def frame(self):
+     """
+     The aggregated rows of the buckets held, as a DataFrame in time order.
+     """
+     if not len(self):
+        return pd.DataFrame(columns=self.output_columns())
+     return self._frame(self.state)
+
+  def _frame(self,state):
+     # by period, then by keys
+     group = state["group"]
+     order = np.lexsort([reductions.codes(g) for g in reversed(group[:-1])] + [group[-1]])
+     state = dict((k,v[order]) for k, v in state.items() if k != "group")
+     columns = dict(zip(self.keys,[g[order] for g in group[:-1]]))
+     with np.errstate(invalid="ignore",divide="ignore"):
+        for a, name in enumerate(self.axis):
+           columns[name] = np.where(state["axis_n"][:,a] > 0,state["axis_sum"][:,a] / state["axis_n"][:,a],np.nan)
+     columns["time"] = state["time_sum"] // state["time_n"]
+     for m, col in enumerate(self.measures):
+        n = state["n"][:,m]
+        present = n > 0
+        columns["mean_{0}".format(col)] = np.where(present,state["mean"][:,m],np.nan)
+        columns["stdev_{0}".format(col)] = reductions.stdev(n,state["m2"][:,m])
+        for name in ["minimum","maximum"]:
+           columns["{0}_{1}".format(name,col)] = optional(state[name][:,m],present,self._int_measures[m])
+           columns["{0}_{1}_time".format(name,col)] = optional(state[name+"_time"][:,m],present,True)
+     return pd.DataFrame(columns,columns=self.output_columns())
+
+  def chunks(self,chunk_rows):
+     """
+     The output rows as DataFrames of up to chunk_rows rows, in time order:
+     those moved aside by spill_finished, then those of frame().
+     """
+     pending = None
+     for df in itertools.chain(self._spilled(),[self.frame()]):
+        if not len(df):
+           continue
+        pending = df if pending is None else pd.concat([pending,df],ignore_index=True)
+        while len(pending) >= chunk_rows:
+           yield pending.iloc[:chunk_rows].reset_index(drop=True)
+           pending = pending.iloc[chunk_rows:]
+     if pending is not None and len(pending):
+        yield pending.reset_index(drop=True)
+
+def stacked(columns,size,dtype):
+   """
+   The per bucket arrays of each column side by side, a (size, columns) array.
+   """
+   if not columns:
+      return np.zeros((size,0),dtype=dtype)
+   return np.column_stack(columns).astype(dtype)
+
+def optional(values,present,integer):
+   """
+   values where present, else NaN. Integers stay integers when none is missing.
+   """
+   if present.all():
+      return values.astype(np.int64) if integer else values
+   return np.where(present,values,np.nan)
+
 class cassandra_table():
   def __init__(self,table_name,summary,variables=None, columns=None):
     self.table_name = table_name
@@ -401,16 +1219,54 @@ class cassandra_table():
 
 class erddap():
   _timeseries = None
-  def __init__(self,base_url):
+  def __init__(self,base_url,workers=1,cache_dir=None,cache_bytes=1024*1024*1024,
+               target_rows=None,target_bytes=None,timeout=300,transport="csv",retries=3,backoff=1.0):
       self.base_url = base_url
+      self.workers = workers
+      self.cache_dir = cache_dir
+      self.cache_bytes = cache_bytes
+      self.target_rows = target_rows
+      self.target_bytes = target_bytes
+      self.timeout = timeout
+      self.transport = transport
+      self.retries = retries
+      self.backoff = backoff
+      self.session = self.new_session()
+
+  def new_session(self):
+      # one keep-alive connection pool shared by every timeseries
+      session = pooled_session(max(self.workers,10),self.retries,self.backoff,self.timeout)
+      if self.cache_dir is not None:
+         session = http_cache(self.cache_dir,session=session,max_bytes=self.cache_bytes)
+      return session
+
+  def reset_session(self):
+      """
+      Gives this erddap and its timeseries a new connection pool, e.g. in a
+      forked worker process that must not share sockets with its parent.
+      """
+      self.session = self.new_session()
+      for ts in self._timeseries or []:
+         ts.session = self.session
+
+  def refresh(self):
+      """
+      Forgets the catalog, the next timeseries() fetches it from the server
+      again, a cached copy is revalidated whatever its age.
+      """
+      self._timeseries = None
+      if isinstance(self.session,http_cache):
+         self.session.expire("{0}/tabledap/allDatasets.".format(self.base_url),datetime.min,datetime.max)
 
   def timeseries(self):
       if not self._timeseries:
          answer = []
          for datatype in ["TimeSeries","Point"]:
            url = "{0}/tabledap/allDatasets.json?&cdm_data_type=%22{1}%22".format(self.base_url,datatype)
-           for t in tabledap(url):
-              answer.append(timeseries(t))
+           for t in tabledap(url,self.session):
+              answer.append(timeseries(t,session=self.session,workers=self.workers,cache_dir=self.cache_dir,
+                                       target_rows=self.target_rows,target_bytes=self.target_bytes,
+                                       timeout=self.timeout,transport=self.transport))
          self._timeseries = answer
 
       return self._timeseries
@@ -0,0 +1,206 @@
+from __future__ import print_function
+import requests
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib
+from datetime import datetime
+
+def parse_upper_time(url):
+  """
+  The upper time bound of a tabledap query (time<... or time<=...), or None
+  """
+  match = re.search(r"<=?(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)",urllib.unquote(url))
+  if match:
+    return datetime.strptime(match.group(1),"%Y-%m-%dT%H:%M:%SZ")
+  return None
+
+def parse_lower_time(url):
+  """
+  The lower time bound of a tabledap query (time>... or time>=...), or None
+  """
+  match = re.search(r">=?(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)",urllib.unquote(url))
+  if match:
+    return datetime.strptime(match.group(1),"%Y-%m-%dT%H:%M:%SZ")
+  return None
+
+class http_cache():
+  """
+  An on-disk cache of GET responses keyed by url, used in place of a
+  requests.Session.
+
+  Dataset metadata urls (info/) live for metadata_ttl seconds, data
+  queries whose upper time bound is more than `grace` seconds in the past
+  live for closed_ttl seconds, and other data queries, the catalog
+  (allDatasets) whose maxTime tells which datasets grew, and the
+  orderByCount and orderByMinMax summaries that tell whether a closed
+  window changed, are revalidated on every use. Expired entries are
+  revalidated with If-None-Match and If-Modified-Since when the server
+  sent an ETag or Last-Modified. The
+  least recently used entries are evicted once the cache grows beyond
+  max_bytes, down to low_water of it. The size is counted as the bodies
+  are stored and the folder only listed again once it reaches max_bytes.
+  """
+  validators = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+  cacheable = [200, 404]
+
+  def __init__(self,cache_dir,session=None,max_bytes=1024*1024*1024,
+               metadata_ttl=24*3600,closed_ttl=30*24*3600,grace=2*24*3600,low_water=0.9):
+    self.cache_dir = cache_dir
+    self.session = session if session is not None else requests.Session()
+    self.max_bytes = max_bytes
+    self.low_water = low_water
+    # the bytes held when the folder was last listed plus the bodies stored since,
+    # other processes sharing the folder are seen at the next listing
+    self.size = None
+    self._size_lock = threading.Lock()
+    self.metadata_ttl = metadata_ttl
+    self.closed_ttl = closed_ttl
+    self.grace = grace
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+
+  def ttl(self,url):
+    if "/info/" in url:
+      return self.metadata_ttl
+    if "/allDatasets." in url or "orderByCount" in url or "orderByMinMax" in url:
+      return 0
+    upper = parse_upper_time(url)
+    if upper is not None and (datetime.utcnow() - upper).total_seconds() > self.grace:
+      return self.closed_ttl
+    return 0
+
+  def _paths(self,url):
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(self.cache_dir,key+".json"), os.path.join(self.cache_dir,key+".body")
+
+  def _load(self,url):
+    meta_path, body_path = self._paths(url)
+    try:
+      with open(meta_path) as f:
+        meta = json.load(f)
+      with open(body_path,"rb") as f:
+        content = f.read()
+    except (IOError,OSError,ValueError):
+      return None, None
+    if meta.get("url") != url:
+      return None, None
+    return meta, content
+
+  def _store(self,url,meta,content=None):
+    meta_path, body_path = self._paths(url)
+    # a temp file per process and thread, several may store the same url at once
+    suffix = ".{0}.{1}.tmp".format(os.getpid(),threading.current_thread().ident)
+    if content is not None:
+      with open(body_path+suffix,"wb") as f:
+        f.write(content)
+      os.rename(body_path+suffix,body_path)
+    with open(meta_path+suffix,"w") as f:
+      json.dump(meta,f)
+    os.rename(meta_path+suffix,meta_path)
+    if content is not None:
+      self.grown(len(content))
+
+  def grown(self,n):
+    with self._size_lock:
+      if self.size is None or self.size + n > self.max_bytes:
+        self.evict()
+      else:
+        self.size += n
+
+  def _response(self,url,meta,content):
+    r = requests.models.Response()
+    r.url = url
+    r.status_code = meta["status_code"]
+    r.headers = requests.structures.CaseInsensitiveDict(meta["headers"])
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    r._content = content
+    r._content_consumed = True
+    return r
+
+  def get(self,url,**kwargs):
+    kwargs.pop("stream",None)
+    meta, content = self._load(url)
+    now = time.time()
+    headers = dict(kwargs.pop("headers",None) or {})
+    if meta is not None:
+      self.touch(url)
+      if now - meta["stored"] < meta["ttl"]:
+        return self._response(url,meta,content)
+      for k, h in self.validators.items():
+        if k in meta["headers"]:
+          headers[h] = meta["headers"][k]
+
+    r = self.session.get(url,headers=headers,**kwargs)
+    if r.status_code == 304 and meta is not None:
+      meta["stored"] = now
+      meta["ttl"] = self.ttl(url)
+      self._store(url,meta)
+      return self._response(url,meta,content)
+    if r.status_code in self.cacheable:
+      meta = {
+          "url": url,
+          "status_code": r.status_code,
+          "headers": dict((k,v) for k,v in r.headers.items() if k in self.validators or k == "Content-Type"),
+          "stored": now,
+          "ttl": self.ttl(url),
+      }
+      self._store(url,meta,r.content)
+    return r
+
+  def expire(self,prefix,start,end):
+    """
+    Expires the cached data queries of urls starting with prefix whose time
+    range overlaps [start, end), datetimes, so they are revalidated on
+    their next use, e.g. once the source of a closed month has changed.
+    """
+    for name in os.listdir(self.cache_dir):
+      if not name.endswith(".json"):
+        continue
+      try:
+        with open(os.path.join(self.cache_dir,name)) as f:
+          meta = json.load(f)
+      except (IOError,OSError,ValueError):
+        continue
+      url = meta.get("url","")
+      if not url.startswith(prefix):
+        continue
+      lower = parse_lower_time(url)
+      upper = parse_upper_time(url)
+      if (lower is None or lower < end) and (upper is None or upper > start):
+        meta["stored"] = 0
+        self._store(url,meta)
+
+  def touch(self,url):
+    try:
+      os.utime(self._paths(url)[1],None)
+    except OSError:
+      pass
+
+  def evict(self):
+    entries = []
+    total = 0
+    for name in os.listdir(self.cache_dir):
+      if not name.endswith(".body"):
+        continue
+      path = os.path.join(self.cache_dir,name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      entries.append((st.st_mtime,st.st_size,path))
+      total += st.st_size
+    entries.sort()
+    if total > self.max_bytes:
+      while total > self.max_bytes*self.low_water and entries:
+        mtime, size, path = entries.pop(0)
+        for p in [path,path[:-len(".body")]+".json"]:
+          try:
+            os.remove(p)
+          except OSError:
+            pass
+        total -= size
+    self.size = total
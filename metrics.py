@@ -0,0 +1,83 @@
+from __future__ import print_function
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import resource
+import threading
+import time
+
+class recorder():
+  """
+  Accumulates wall and cpu seconds per named stage and counters such as
+  rows and bytes, and writes structured events as JSON lines to `out`
+  (nothing is written while out is None). The cpu seconds are process
+  wide, so stages running on several threads at once overlap.
+  """
+  def __init__(self,out=None):
+    self.out = out
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.stages = {}
+      self.counters = {}
+
+  @contextmanager
+  def stage(self,name):
+    wall = time.time()
+    cpu = time.clock()
+    try:
+      yield
+    finally:
+      with self.lock:
+        s = self.stages.setdefault(name,{"seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+        s["seconds"] += time.time() - wall
+        s["cpu_seconds"] += time.clock() - cpu
+        s["calls"] += 1
+
+  def count(self,name,n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name,0) + n
+
+  def record(self,event,**fields):
+    if self.out is None:
+      return
+    fields["event"] = event
+    fields["time"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    line = json.dumps(fields,sort_keys=True)
+    with self.lock:
+      self.out.write(line+"\n")
+      self.out.flush()
+
+  def summary(self):
+    with self.lock:
+      return {
+        "stages": dict((k,dict(v)) for k, v in self.stages.items()),
+        "counters": dict(self.counters),
+        "peak_rss_kb": peak_rss_kb(),
+      }
+
+def peak_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# the recorder used by erddap.py and aggrerddap.py
+_recorder = recorder()
+
+def configure(out):
+  _recorder.out = out
+
+def stage(name):
+  return _recorder.stage(name)
+
+def count(name,n=1):
+  _recorder.count(name,n)
+
+def record(event,**fields):
+  _recorder.record(event,**fields)
+
+def summary():
+  return _recorder.summary()
+
+def reset():
+  _recorder.reset()
@@ -0,0 +1,119 @@
+"""
+Grouped reductions over numpy arrays. The rows are sorted by their bucket
+keys once, then the count, sum, mean, M2, minimum and maximum of a column,
+and the rows holding its minimum and maximum, are worked out for every
+bucket at once with ufunc.reduceat. NaN values are skipped, as sqlite
+skips NULLs, so the results match the stdev aggregate of aggrerddap.
+
+  g = groups(station_ids,hours)
+  r = g.reduce(temperatures)
+  stdev(r["count"],r["m2"])
+"""
+import numpy as np
+
+def stdev(count,m2):
+   """
+   The sample standard deviation of each bucket from its count and M2, NaN
+   for buckets of fewer than two values, as StdevFunc.finalize.
+   """
+   count = np.asarray(count)
+   with np.errstate(invalid="ignore",divide="ignore"):
+      return np.where(count > 1,np.sqrt(m2 / (count - 1)),np.nan)
+
+class groups():
+  """
+  The buckets of rows sharing the same keys, from one or more key arrays of
+  the same length, the first the most significant. `order` sorts the rows
+  by bucket keeping their original order within a bucket, `starts` is
+  where each bucket begins in that order, `counts` its number of rows and
+  `first` the index of its first row.
+  """
+  def __init__(self,*keys):
+    keys = [np.asarray(k) for k in keys]
+    self.size = len(keys[0])
+    self.order = np.lexsort([codes(k) for k in reversed(keys)])
+    change = np.zeros(self.size,dtype=bool)
+    change[:1] = True
+    for k in keys:
+      k = k[self.order]
+      differs = k[1:] != k[:-1]
+      if k.dtype.kind == "f":
+        differs &= ~(np.isnan(k[1:]) & np.isnan(k[:-1]))
+      change[1:] |= differs
+    self.starts = np.flatnonzero(change)
+    self.counts = np.diff(np.append(self.starts,self.size))
+    self.first = self.order[self.starts]
+
+  def __len__(self):
+    return len(self.starts)
+
+  def sum(self,values):
+    """
+    The sum per bucket of values, along the first axis of 2 dimensional ones.
+    """
+    values = np.asarray(values)
+    if not self.size:
+      return np.zeros((0,)+values.shape[1:],dtype=values.dtype)
+    return np.add.reduceat(values[self.order],self.starts)
+
+  def expand(self,values):
+    """
+    Repeats one value per bucket for each row of the bucket, in sorted order.
+    """
+    return np.repeat(values,self.counts,axis=0)
+
+  def broadcast(self,values):
+    """
+    The value of its bucket for each row, in the original order of the rows.
+    """
+    values = np.asarray(values)
+    answer = np.empty((self.size,)+values.shape[1:],dtype=values.dtype)
+    answer[self.order] = self.expand(values)
+    return answer
+
+  def _first(self,hits):
+    # the row of the first hit of each bucket, -1 where there is none
+    positions = np.where(hits,np.arange(self.size),self.size)
+    first = np.minimum.reduceat(positions,self.starts)
+    return np.where(first < self.size,self.order[np.minimum(first,self.size-1)],-1)
+
+  def reduce(self,values):
+    """
+    A dict of the count, sum, mean, m2 (the sum of squared deviations from
+    the mean), minimum and maximum of `values` per bucket, and argmin and
+    argmax, the index of the first row holding the minimum or maximum or
+    -1. Buckets without values have a NaN mean, minimum and maximum.
+    """
+    v = np.asarray(values,dtype=np.float64)
+    if not self.size:
+      empty = np.zeros(0)
+      none = np.zeros(0,dtype=np.int64)
+      return {"count": none, "sum": empty, "mean": empty, "m2": empty,
+              "minimum": empty, "maximum": empty, "argmin": none, "argmax": none}
+    v = v[self.order]
+    valid = ~np.isnan(v)
+    count = np.add.reduceat(valid.astype(np.int64),self.starts)
+    total = np.add.reduceat(np.where(valid,v,0.0),self.starts)
+    empty = count == 0
+    with np.errstate(invalid="ignore",divide="ignore"):
+      mean = total / count
+    # two passes, the deviations from the bucket mean, for the accuracy of Welford's update
+    deviation = np.where(valid,v - self.expand(mean),0.0)
+    m2 = np.add.reduceat(deviation*deviation,self.starts)
+    minimum = np.minimum.reduceat(np.where(valid,v,np.inf),self.starts)
+    maximum = np.maximum.reduceat(np.where(valid,v,-np.inf),self.starts)
+    minimum[empty] = np.nan
+    maximum[empty] = np.nan
+    return {"count": count, "sum": total, "mean": mean, "m2": m2,
+            "minimum": minimum, "maximum": maximum,
+            "argmin": self._first(valid & (v == self.expand(minimum))),
+            "argmax": self._first(valid & (v == self.expand(maximum)))}
+
+def codes(keys):
+   """
+   Sortable integer codes of a key array, the array itself when numeric.
+   """
+   keys = np.asarray(keys)
+   if keys.dtype.kind in "biuf":
+      return keys
+   return np.unique(keys,return_inverse=True)[1]
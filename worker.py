@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from aggrerddap import add_aggregate_arguments, aggregate, aggregate_options, check_aggregate_arguments, ensure_dir, erddap_from_args, instrumented, valid_date, valid_periods, AGGREGATE_OPTIONS, PERIODS
+from datetime import date
+from multiprocessing import Pool, cpu_count
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+
+# a job file moves from queue to running, then to done or failed
+STATES = ["queue","running","done","failed"]
+
+# the traceback of a failed job is written next to it in failed
+ERROR_SUFFIX = ".error.txt"
+
+# set before the pool forks, every worker starts from the catalog loaded once
+# and keeps the metadata of the series it aggregates for the following jobs
+_erddap = None
+_timeseries = {}
+_options = {}
+
+def job_dir(jobs_dir,state):
+  return os.path.join(jobs_dir,state)
+
+def make_job_dirs(jobs_dir):
+  for state in STATES:
+    ensure_dir(job_dir(jobs_dir,state))
+
+def submit(jobs_dir,series,month,periods=None,**options):
+  """
+  Queues the aggregation of one month of a series. The other options
+  (constraints, engine, incremental, chunk_rows, partition, compression,
+  float32, skip_unchanged_source) override the runner's.
+  Returns the path of the job file.
+  """
+  make_job_dirs(jobs_dir)
+  job = dict(options,series=series,month=month.strftime("%Y-%m"))
+  if periods is not None:
+    job["periods"] = periods
+  name = "{0:.6f}_{1}_{2}.json".format(time.time(),series,job["month"])
+  path = os.path.join(job_dir(jobs_dir,"queue"),name)
+  # written aside and renamed, a runner never reads half a job
+  tmp = os.path.join(jobs_dir,".{0}.tmp".format(name))
+  with open(tmp,"w") as out:
+    json.dump(job,out,indent=1,sort_keys=True)
+  os.rename(tmp,path)
+  return path
+
+def claim(jobs_dir):
+  """
+  Moves the oldest queued job to running and returns its new path, or None
+  when the queue is empty. Runners sharing the folder never take the same
+  job, the rename of only one of them succeeds.
+  """
+  for name in sorted(os.listdir(job_dir(jobs_dir,"queue"))):
+    if not name.endswith(".json"):
+      continue
+    queued = os.path.join(job_dir(jobs_dir,"queue"),name)
+    path = os.path.join(job_dir(jobs_dir,"running"),name)
+    try:
+      # touched before the rename, a job never shows in running as stale
+      os.utime(queued,None)
+      os.rename(queued,path)
+    except OSError:
+      continue
+    return path
+  return None
+
+def heartbeat(paths):
+  # the modification time of a running job tells the other runners its runner is alive
+  for path in paths:
+    try:
+      os.utime(path,None)
+    except OSError:
+      pass
+
+def requeue_stale(jobs_dir,stale):
+  """
+  Moves back to the queue the running jobs that no runner touched for
+  `stale` seconds, left by a runner that crashed or was killed.
+  """
+  running = job_dir(jobs_dir,"running")
+  for name in sorted(os.listdir(running)):
+    path = os.path.join(running,name)
+    try:
+      if time.time() - os.path.getmtime(path) < stale:
+        continue
+      os.rename(path,os.path.join(job_dir(jobs_dir,"queue"),name))
+    except OSError:
+      continue
+    print("requeued {0}".format(name),file=sys.stderr)
+
+def finish(jobs_dir,path,error):
+  """
+  Moves the job file, as it was submitted, to done or to failed with its
+  traceback in a file beside it.
+  """
+  state = "done" if error is None else "failed"
+  target = os.path.join(job_dir(jobs_dir,state),os.path.basename(path))
+  if error is not None:
+    with open(os.path.splitext(target)[0] + ERROR_SUFFIX,"w") as out:
+      out.write(error)
+  try:
+    shutil.move(path,target)
+  except (IOError,OSError):
+    # requeued by another runner that found it stale
+    print("lost {0}".format(path),file=sys.stderr)
+    return
+  if error is None:
+    print("done {0}".format(target))
+  else:
+    print("failed {0}\n{1}".format(target,error),file=sys.stderr)
+
+def load_catalog():
+  # the catalog from the server, even with a cache, datasets may have been added or removed since the last one
+  _erddap.refresh()
+  _timeseries.clear()
+  _timeseries.update({ts.id: ts for ts in _erddap.timeseries()})
+
+def init_worker():
+  _erddap.reset_session()
+
+def run_job(path):
+  try:
+    with open(path) as f:
+      job = json.load(f)
+    o = dict(_options)
+    o.update(job)
+    if o["series"] not in _timeseries:
+      raise ValueError("unknown timeseries {0}".format(o["series"]))
+    periods = o["periods"]
+    if isinstance(periods,basestring):
+      periods = valid_periods(periods)
+    month = valid_date(o["month"])
+    aggregate(_timeseries[o["series"]],date(month.year,month.month,1),periods,
+              **dict((name,o[name]) for name in AGGREGATE_OPTIONS))
+    return path, None
+  except Exception:
+    return path, traceback.format_exc()
+
+def serve(jobs_dir,processes,poll=5,refresh=3600,once=False,stale=600):
+  """
+  Runs the queued jobs, at most `processes` at a time, on a pool of long
+  lived processes. The catalog is reloaded and the pool started again
+  every `refresh` seconds. The running jobs are touched every quarter of
+  `stale` seconds, and those of other runners left untouched longer are
+  queued again. With once, returns when the queue is empty.
+  Returns the number of failed jobs.
+  """
+  make_job_dirs(jobs_dir)
+  failed = 0
+  touched = 0
+  while True:
+    load_catalog()
+    pool = Pool(processes,initializer=init_worker)
+    started = time.time()
+    running = []
+    try:
+      # after refresh seconds no job is taken, the running ones finish before the catalog is reloaded
+      while running or time.time() - started < refresh:
+        for result in [r for r in running if r.ready()]:
+          running.remove(result)
+          path, error = result.get()
+          failed += error is not None
+          finish(jobs_dir,path,error)
+        if time.time() - touched >= stale/4.0:
+          heartbeat([r.path for r in running])
+          requeue_stale(jobs_dir,stale)
+          touched = time.time()
+        taking = time.time() - started < refresh and len(running) < processes
+        path = claim(jobs_dir) if taking else None
+        if path is not None:
+          result = pool.apply_async(run_job,(path,))
+          result.path = path
+          running.append(result)
+        elif once and not running:
+          return failed
+        else:
+          time.sleep(min(poll,0.5) if running else poll)
+    finally:
+      pool.close()
+      pool.join()
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Run aggregation jobs queued as files in a folder, keeping the catalog and the metadata of each series in memory between jobs. The options of the aggregation apply to the jobs that don't set them.")
+   parser.add_argument("jobs_dir", help="Folder of the queue, running, done and failed job files")
+   parser.add_argument("--submit", nargs=3, metavar=("SERIES","YYYY-MM","PERIOD"), help="Queue a job instead of running them, the period a comma separated list from {0}, or all".format(",".join(PERIODS)))
+   parser.add_argument("--once", help="Exit once the queue is empty, instead of waiting for more jobs", action="store_true")
+   parser.add_argument("--poll", help="Seconds between looks at an empty queue", type=float, default=5)
+   parser.add_argument("--refresh", help="Seconds between reloads of the catalog", type=float, default=3600)
+   parser.add_argument("--stale", help="Seconds after which a running job no runner touched, its runner dead, is queued again", type=float, default=600)
+   parser.add_argument("--processes", help="Number of jobs run in parallel", type=int, default=cpu_count())
+   add_aggregate_arguments(parser)
+   parser.add_argument("--constraint", dest="constraints", action="append", default=[], help='a constraint included in the query eg, "temp<=25", may be repeated')
+   args = parser.parse_args()
+   if args.submit:
+     series, month, period = args.submit
+     try:
+       month = valid_date(month)
+       valid_periods(period)
+     except argparse.ArgumentTypeError as e:
+       parser.error(str(e))
+     options = {"constraints": args.constraints} if args.constraints else {}
+     print(submit(args.jobs_dir,series,month,period,**options))
+     sys.exit(0)
+   check_aggregate_arguments(parser,args)
+
+   _erddap = erddap_from_args(args)
+   _options.update(aggregate_options(args))
+   _options["periods"] = PERIODS
+   # the workers inherit the metrics file
+   with instrumented(args.metrics):
+     failed = serve(args.jobs_dir,args.processes,args.poll,args.refresh,args.once,args.stale)
+   sys.exit(1 if failed else 0)